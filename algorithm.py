@@ -1,63 +1,215 @@
 from clustering import *
+from ingestion import *
+from community_detection import *
+from similarity_graph import *
 import subprocess as sp #https://docs.python.org/3.4/library/subprocess.html
-import networkx as nx
-import community
 import re
 import os
-import statistics
-import pdb
 import shutil
-import re
 import glob2
-import json
+import multiprocessing
+import pickle
+import numpy as np
 
-def _prefix_of(name, level=0):
+_PREFIX = re.compile(r'(?P<prefix>[^(]+)')
+
+def _package_path_of(name, level=0):
 	unified_name = name.replace('.', '/').replace('::', '/')
-	match = re.search(r'(?P<prefix>[^(]+)', unified_name)
+	match = _PREFIX.search(unified_name)
 	prefix = 'unknown'
 	if match:
 		prefix = match.group('prefix')
-	return '/'.join(prefix.split('/')[:(-2 - level)])
+	return tuple(prefix.split('/')[:(-2 - level)])
 
-def _load_labels(labels_dir):
+def _prefix_of(name, level=0):
+	return '/'.join(_package_path_of(name, level))
+
+def _read_label_file(labels_csv_path):
 	labels = {}
+	with open(labels_csv_path, 'r') as label_file:
+		for line in label_file:
+			parts = line.strip().split(';')
+			labels[parts[0]] = parts[2]
+	return labels
+
+def _label_files(labels_dir):
+	"""The label csv files with the modification time and size that identify their content."""
 	paths = glob2.glob(os.path.join(labels_dir, '**/*.csv'))
+	return [(path, os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in paths]
 
-	for labels_csv_path in paths:
-		with open(labels_csv_path, 'r') as label_file:
-			for line in label_file:
-				parts = line.strip().split(';')
-				labels[parts[0]] = parts[2]
+def labels_fingerprint(labels_dir):
+	"""Identifies the content of a labels directory by the paths, modification times and sizes of its label files."""
+	return _label_files(labels_dir) if labels_dir else []
 
-	return labels
+def _load_labels(labels_dir, index_path=None, workers=1):
+	"""Labels of the names in the csv files of labels_dir, later files overriding earlier ones.
+
+	Files are parsed by a pool of workers when more than one is given. With an index_path the merged
+	labels are persisted and reused until any label file is added, removed, modified or resized.
+	"""
+	files = _label_files(labels_dir)
+	if index_path and files and os.path.isfile(index_path):
+		with open(index_path, 'rb') as index_file:
+			index = pickle.load(index_file)
+		if index.get('files') == files:
+			print("Using label index %s" % index_path)
+			return index['labels']
+		print("Label index %s is stale, reloading the labels" % index_path)
 
-def _label_of(name, labels, level=0, fallback=None):
-	if name in labels:
-		label = labels[name]
-		print("Using label '%s' for '%s'" % (label, name))
-		return label
+	paths = [path for path, _, _ in files]
+	if workers > 1 and len(paths) > 1:
+		with multiprocessing.Pool(min(workers, len(paths))) as pool:
+			parsed = pool.map(_read_label_file, paths)
 	else:
-		if fallback:
-			if isinstance(fallback, str):
-				print("Using fallback label '%s' for '%s'" % (fallback, name))
-				return fallback
+		parsed = [_read_label_file(path) for path in paths]
+	labels = {}
+	for file_labels in parsed:
+		labels.update(file_labels)
+
+	if index_path and files:
+		with open(index_path, 'wb') as index_file:
+			pickle.dump({'files': files, 'labels': labels}, index_file, protocol=pickle.HIGHEST_PROTOCOL)
+	return labels
+
+def build_label_index(labels_dir, index_path, workers=1):
+	"""Persist the labels of a directory to index_path, unless the index there is up to date."""
+	_load_labels(labels_dir, index_path=index_path, workers=workers)
+
+class _SuffixAutomaton(object):
+	"""Suffix automaton of one string tracking, for every state, the longest match shared by a set of other strings."""
+	def __init__(self, text):
+		self.transitions = [{}]
+		self.link = [-1]
+		self.length = [0]
+		self.first_end = [-1]
+		last = 0
+		for position, char in enumerate(text):
+			state = self._add_state(self.length[last] + 1, position)
+			parent = last
+			while parent != -1 and char not in self.transitions[parent]:
+				self.transitions[parent][char] = state
+				parent = self.link[parent]
+			if parent == -1:
+				self.link[state] = 0
 			else:
-				raise Exception("The 'fallback' attribute must be a string.")
-		else:
-			return _prefix_of(name, level)
+				child = self.transitions[parent][char]
+				if self.length[parent] + 1 == self.length[child]:
+					self.link[state] = child
+				else:
+					clone = self._add_state(self.length[parent] + 1, self.first_end[child])
+					self.transitions[clone] = dict(self.transitions[child])
+					self.link[clone] = self.link[child]
+					while parent != -1 and self.transitions[parent].get(char) == child:
+						self.transitions[parent][char] = clone
+						parent = self.link[parent]
+					self.link[child] = self.link[state] = clone
+			last = state
+		self.by_length = sorted(range(1, len(self.length)), key=self.length.__getitem__, reverse=True)
+		self.common = list(self.length)
+
+	def _add_state(self, length, first_end):
+		self.transitions.append({})
+		self.link.append(-1)
+		self.length.append(length)
+		self.first_end.append(first_end)
+		return len(self.length) - 1
+
+	def intersect(self, text):
+		"""Shorten the common match of every state to what also occurs in text."""
+		matched = [0] * len(self.length)
+		state = length = 0
+		for char in text:
+			while state and char not in self.transitions[state]:
+				state = self.link[state]
+				length = self.length[state]
+			if char in self.transitions[state]:
+				state = self.transitions[state][char]
+				length += 1
+			if length > matched[state]:
+				matched[state] = length
+		for state in self.by_length:
+			if matched[state]:
+				matched[self.link[state]] = self.length[self.link[state]]
+			if matched[state] < self.common[state]:
+				self.common[state] = matched[state]
+
+	def longest(self, text):
+		"""The longest common match, the earliest in text among equally long ones."""
+		best = max(self.common)
+		if best == 0:
+			return ''
+		end = min(self.first_end[state] for state, common in enumerate(self.common) if common == best)
+		return text[end - best + 1:end + 1]
+
+_NAME_PART = re.compile(r'[A-Z]?[^\WA-Z]*')
+_SKIPPED_PART = re.compile(r'([tT]est|Lorg)')
+
+class _NameTokens(object):
+	"""Interned name parts: a name is split once into the ids of its parts.
+
+	A part starts at an upper case letter or after a non-word character and holds the following
+	word characters that are not upper case letters. Empty and test or Lorg parts are dropped.
+	"""
+	def __init__(self):
+		self._id_of_token = {}
+		self._tokens = []
+		self._long = []
+		self._long_array = np.zeros(0, dtype=bool)
+		self._ids_of_name = {}
+
+	def ids_of(self, name):
+		ids = self._ids_of_name.get(name)
+		if ids is None:
+			ids = self._ids_of_name[name] = tuple(self._intern(part) for part in _NAME_PART.findall(name) if not (part == '' or _SKIPPED_PART.search(part)))
+		return ids
+
+	def _intern(self, token):
+		token_id = self._id_of_token.get(token)
+		if token_id is None:
+			token_id = self._id_of_token[token] = len(self._tokens)
+			self._tokens.append(token)
+			self._long.append(len(token) > 1)
+		return token_id
+
+	def token(self, token_id):
+		return self._tokens[token_id]
+
+	def is_long(self, token_ids):
+		if len(self._long_array) != len(self._long):
+			self._long_array = np.array(self._long, dtype=bool)
+		return self._long_array[token_ids]
+
+def _longest_common_substr(data):
+	automaton = _SuffixAutomaton(data[0])
+	pending = list(dict.fromkeys(data[1:]))
+	substr = data[0]
+	while pending:
+		# strings already holding the current candidate cannot change the answer unless a later one breaks it
+		deferred = []
+		for text in pending:
+			if substr in text:
+				deferred.append(text)
+				continue
+			automaton.intersect(text)
+			substr = automaton.longest(data[0])
+			if substr == '':
+				return ''
+		if len(deferred) == len(pending):
+			break
+		pending = deferred
+	return substr
 
 def _longest_substr(data):
-	substr = ''
+	"""The longest substring of data[0] found in every string of data, the earliest one in data[0] on ties."""
+	data = list(data)
 	if len(data) == 1:
 		return data[0]
 	if len(data) > 1 and len(data[0]) > 0:
-		for i in range(len(data[0])):
-			for j in range(len(data[0])-i+1):
-				if j > len(substr) and all(data[0][i:i+j] in x for x in data):
-					substr = data[0][i:i+j]
-	return substr
+		return _longest_common_substr(data)
+	return ''
 
-def _rawcount(filename):
+def _rawcount(filename, offsets=False):
+	"""Count the lines of a file; with offsets, also return the byte offset where each following row starts."""
 	buf_size = 32 * 1024 * 1024
 
 	def _makegen(reader):
@@ -68,127 +220,191 @@ def _rawcount(filename):
 
 	with open(filename, 'rb') as f:
 		f_gen = _makegen(f.raw.read)
-		return sum(buf.count(b'\n') for buf in f_gen)
+		if not offsets:
+			return sum(buf.count(b'\n') for buf in f_gen)
+		row_offsets = []
+		position = 0
+		for buf in f_gen:
+			row_offsets.append(np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == ord('\n')) + position + 1)
+			position += len(buf)
+		row_offsets = np.concatenate(row_offsets) if row_offsets else np.zeros(0, dtype=np.int64)
+		return len(row_offsets), row_offsets
+
+def _run_louvain(bin_edge_list_path):
+	louvain = sp.Popen(['./louvain', '-v', '-l', '-1', bin_edge_list_path], stdout=sp.PIPE)
+	hierarchy = sp.Popen(['./hierarchy', '-m', '/dev/stdin'], stdin=louvain.stdout, stdout=sp.PIPE)
+	louvain.stdout.close()
+	output = hierarchy.communicate()[0]
+	if louvain.wait() != 0 or hierarchy.returncode != 0:
+		raise Exception("Running louvain on '%s' failed" % bin_edge_list_path)
+	return output
 
 class CoverageBasedData(object):
-	def __init__(self, path_to_dump, drop_uncovered=False, regenerate_edge_list=True):
+	def __init__(self, path_to_dump, drop_uncovered=False, regenerate_edge_list=True, streaming=False, memory_budget=None, workers=1, incremental=False):
 		self._soda_dump = path_to_dump
-		self._create_edge_list(path_to_dump, regenerate_edge_list=regenerate_edge_list)
-		all_names = [datum['name'] for _, datum in self.data.items()]
-		self._most_common = _longest_substr(all_names)
+		self._create_edge_list(path_to_dump, regenerate_edge_list=regenerate_edge_list, streaming=streaming, memory_budget=memory_budget, workers=workers, incremental=incremental)
+		self._most_common = _longest_substr(self.data.names)
 
-	def _create_edge_list(self, matrix_csv_path, regenerate_edge_list=True):
+	def _create_edge_list(self, matrix_csv_path, regenerate_edge_list=True, streaming=False, memory_budget=None, workers=1, incremental=False):
+		"""Convert the matrix, or reuse the conversion of the same content; incrementally, self.delta holds what changed."""
 		base_name = os.path.join(os.path.dirname(matrix_csv_path), os.path.splitext(os.path.basename(matrix_csv_path))[0])
 		self.edge_list_path = '%s.edges.csv' % base_name
 		self.data_mapping_path = '%s.data.csv' % base_name
+		self.node_table_path = '%s.nodes.bin' % base_name
+		self.ingestion_state_path = '%s.state.npz' % base_name
+		self.ingestion_report = None
+		self.ingestion_state = None
+		self.delta = None
+		digest = file_digest(matrix_csv_path)
+		self.digest = digest
+		if incremental and streaming:
+			raise Exception("Incremental ingestion cannot be combined with streaming")
+		state = IngestionState.load(self.ingestion_state_path) if incremental else None
+
+		if not regenerate_edge_list and os.path.isfile(self.edge_list_path) and (not incremental or state is not None and state.digest == digest):
+			table = NodeTable.load(self.node_table_path, digest)
+			if table is not None:
+				self.data = table
+				self.matrix = self.numbering = None
+				self.ingestion_state = state
+				return
+			print("Node table cache of '%s' is missing or stale, regenerating the edge list" % matrix_csv_path)
 
-		if not regenerate_edge_list and os.path.isfile(self.edge_list_path) and os.path.isfile(self.data_mapping_path):
-			with open(self.data_mapping_path, 'r') as data_mapping:
-				self.data = dict([json.loads(line) for line in data_mapping])
+		if state is not None and state.digest != digest:
+			self.data, self.ingestion_state, self.delta, self.ingestion_report = update_matrix(matrix_csv_path, self.edge_list_path, self.data_mapping_path, state, digest)
+			self.matrix = self.numbering = None
+			self.data.save(self.node_table_path, digest)
+			self.ingestion_state.save(self.ingestion_state_path)
+			print("Incremental ingestion: %d nodes added, %d removed, %d edges added, %d removed" % (len(self.delta.added_nodes), len(self.delta.removed_nodes), len(self.delta.added_edges[0]), len(self.delta.removed_edges[0])))
 			return
 
-		self.data = {}
-		count_lines = _rawcount(matrix_csv_path)
-
-		with open(matrix_csv_path, 'r') as matrix, open(self.edge_list_path, 'w') as edge_list:
-			header = next(matrix).strip()
-			code_elements = header.split(';')[1:]
-			global_node_index = '0'
-			code_map = {}
-			test_map = {}
-			for test_index, line in enumerate(matrix):
-				print("converting matrix to edges, done: %.4f" % (test_index / count_lines))
-				parts = line.strip().split(';')
-				test_name = parts[0]
-				for code_index, connection in enumerate(parts[1:]):
-					code_name = code_elements[code_index]
-					if int(connection) > 0:
-						if code_index not in code_map:
-							code_map[code_index] = global_node_index
-							global_node_index = str(int(global_node_index)+1)
-						if test_index not in test_map:
-							test_map[test_index] = global_node_index
-							global_node_index = str(int(global_node_index)+1)
-						current_code_node = code_map[code_index]
-						current_test_node = test_map[test_index]
-						if current_test_node not in self.data:
-							self.data[current_test_node] = {}
-						self.data[current_test_node]['name'] = test_name
-						self.data[current_test_node]['domain'] = 'test'
-						if current_code_node not in self.data:
-							self.data[current_code_node] = {}
-						self.data[current_code_node]['name'] = code_name
-						self.data[current_code_node]['domain'] = 'code'
-						edge_list.write('%s %s\n' % (current_code_node, current_test_node))
-		with open(self.data_mapping_path, 'w') as data_mapping:
-			for entry in self.data.items():
-				data_mapping.write('%s\n' % json.dumps(entry))
-
-	def package_based_clustering(self, name, labels_dir=None, level=0, key='declared_cluster'):
-		mapping = {}
+		if workers > 1:
+			count_lines, row_offsets = _rawcount(matrix_csv_path, offsets=True)
+		else:
+			count_lines, row_offsets = _rawcount(matrix_csv_path), None
+		self.matrix, self.numbering, self.data, self.ingestion_report = convert_matrix(matrix_csv_path, self.edge_list_path, self.data_mapping_path, count_lines=count_lines, streaming=streaming, memory_budget=memory_budget, workers=workers, row_offsets=row_offsets)
+		self.data.save(self.node_table_path, digest)
+		if incremental:
+			self.ingestion_state = IngestionState.of_conversion(digest, self.matrix, self.numbering)
+			self.ingestion_state.save(self.ingestion_state_path)
+		print("ingested %d rows into %d nodes and %d edges in %d blocks, peak memory %.1f MB" % (self.ingestion_report.rows, self.ingestion_report.nodes, self.ingestion_report.edges, self.ingestion_report.blocks, self.ingestion_report.peak_memory / 2 ** 20))
 
+	def package_based_clustering(self, name, labels_dir=None, level=0, key='declared_cluster', workers=1, label_index=None):
+		labels = {}
 		if labels_dir:
-			labels = _load_labels(labels_dir)
+			base_name = os.path.join(os.path.dirname(self._soda_dump), os.path.splitext(os.path.basename(self._soda_dump))[0])
+			labels = _load_labels(labels_dir, index_path=label_index or '%s.labels.idx' % base_name, workers=workers)
 
-		for node, data in self.data.items():
-			name_of_node = data.get('name', 'noname')
-			if labels:
-				mapping[str(node)] = _label_of(name_of_node, labels, level=level, fallback="unknown")
-			else:
-				mapping[str(node)] = _prefix_of(name_of_node, level=level)
+		nodes = [str(node) for node in self.data]
+		names = list(self.data.names)
+		if labels:
+			resolved = [labels.get(name_of_node) for name_of_node in names]
+			fallbacks = resolved.count(None)
+			print("Labels: %d nodes labelled, %d used the fallback label 'unknown'" % (len(resolved) - fallbacks, fallbacks))
+			mapping = {node: 'unknown' if label is None else label for node, label in zip(nodes, resolved)}
+		else:
+			mapping = {node: _prefix_of(name_of_node, level=level) for node, name_of_node in zip(nodes, names)}
 
 		return Clustering(mapping, name, key, self.data)
 
-	def community_based_clustering(self, name, key='community_cluster', regenerate_external_data=False):
-		base_name = os.path.join(os.path.dirname(self._soda_dump), os.path.splitext(os.path.basename(self._soda_dump))[0])
+	def package_hierarchy(self, name, levels=3, key='declared_cluster'):
+		"""Package based clusterings of the given number of levels (see package_based_clustering) in one pass over the names."""
+		index_of_path = {}
+		codes = np.fromiter((index_of_path.setdefault(_package_path_of(self.data.name_of(node), 0), len(index_of_path)) for node in self.data), dtype=np.int64, count=len(self.data))
+		paths = list(index_of_path)
+		labels = []
+		parents = []
+		for level in range(levels):
+			labels.append(['/'.join(path) for path in paths])
+			if level + 1 < levels:
+				index_of_parent = {}
+				parents.append(np.array([index_of_parent.setdefault(path[:-1], len(index_of_parent)) for path in paths], dtype=np.int64))
+				paths = list(index_of_parent)
+		return ClusteringHierarchy(name, key, self.data, [str(node) for node in self.data], codes, labels, parents)
+
+	def edge_arrays(self):
+		if self.matrix is not None:
+			return self.numbering.edge_arrays(self.matrix)
+		if self.ingestion_state is not None:
+			return self.ingestion_state.edge_arrays()
+		edges = np.loadtxt(self.edge_list_path, dtype=np.int64, ndmin=2).reshape(-1, 2)
+		return edges[:, 0], edges[:, 1]
 
-		bin_edge_list_path = '%s.edges.bin' % base_name
-		if regenerate_external_data or not os.path.isfile(bin_edge_list_path):
-			sp.call('./convert -i %s -o %s' % (self.edge_list_path, bin_edge_list_path), shell=True)
+	def community_based_clustering(self, name, key='community_cluster', regenerate_external_data=False, engine='external'):
+		if engine == 'builtin':
+			sources, targets = self.edge_arrays()
+			communities, self.community_levels = louvain(*adjacency_of(sources, targets, len(self.data.row_of_id)))
+			mapping = {str(node): str(community) for node, community in zip(self.data.ids.tolist(), communities[self.data.ids].tolist())}
+			return Clustering(mapping, name, key, self.data)
+		elif engine != 'external':
+			raise Exception("Unknown community detection engine (%s)" % engine)
 
-		tree_path = '%s.tree' % base_name
-		if regenerate_external_data or not os.path.isfile(tree_path):
-			sp.call('./louvain -v -l -1 %s > %s' % (bin_edge_list_path, tree_path), shell=True)
+		base_name = os.path.join(os.path.dirname(self._soda_dump), os.path.splitext(os.path.basename(self._soda_dump))[0])
 
 		self.community_map_path = '%s.map.csv' % base_name
 		if regenerate_external_data or not os.path.isfile(self.community_map_path):
-			sp.call('./hierarchy -m %s > %s' % (tree_path, self.community_map_path), shell=True)
+			bin_edge_list_path = '%s.edges.bin' % base_name
+			if regenerate_external_data or not os.path.isfile(bin_edge_list_path):
+				sources, targets = self.edge_arrays()
+				node_count = int(max(sources.max(), targets.max())) + 1 if len(sources) else 0
+				with open(bin_edge_list_path, 'wb') as bin_edge_list:
+					write_louvain_graph(bin_edge_list, *adjacency_of(sources, targets, node_count)[:2])
+			with open(self.community_map_path, 'wb') as mapping_file:
+				mapping_file.write(_run_louvain(bin_edge_list_path))
 
 		mapping = {}
 		with open(self.community_map_path, 'r') as mapping_file:
 			for line in mapping_file:
 				parts = line.strip().split(' ')
-				mapping[parts[0]] = parts[1]
+				if parts[0] in self.data:
+					mapping[parts[0]] = parts[1]
 
 		return Clustering(mapping, name, key, self.data)
 
-	def save(self, name, clusterings=[], similarity_constrain=lambda v: v):
+	def save(self, name, clusterings=[], similarity_constrain=lambda v: v, export=('graphml',), similarity_models=None):
+		"""Build the similarity models of the clusterings, unless already built ones are given, and export them in the given formats ('graphml', 'binary'), if any."""
 		dir = os.path.join(os.path.dirname(name), '%s-graphs' % os.path.splitext(os.path.basename(name))[0])
 		if os.path.isdir(dir):
 			shutil.rmtree(dir)
-		os.makedirs(dir)
-		self.similarity_models = {}
-		self.similarity_models['jaccard'] = self._create_similarity_map(dir, clusterings, similarity_name='J', similarity=jaccard_similarity_coefficient, constrain=similarity_constrain)
-		self.similarity_models['f-measure'] = self._create_similarity_map(dir, clusterings, similarity_name='F', similarity=f_measuere, constrain=similarity_constrain)
-		self.similarity_models['inclusion'] = self._create_similarity_map(dir, clusterings, similarity_name='I', similarity=inclusion_coefficient, constrain=similarity_constrain)
+		if export:
+			os.makedirs(dir)
+		if similarity_models is None:
+			similarity_models = self.build_similarity_models(clusterings, similarity_constrain)
+		self.similarity_models = similarity_models
+		for model in similarity_models.values():
+			if 'graphml' in export:
+				model.write_graphml(os.path.join(dir, 'similarity.model_%s.graphml' % model.similarity_name))
+			if 'binary' in export:
+				model.save_binary(os.path.join(dir, 'similarity.model_%s.npz' % model.similarity_name))
+
+	def build_similarity_models(self, clusterings, similarity_constrain=lambda v: v):
+		cluster_nodes = self._cluster_nodes(clusterings)
+		overlaps = self._cluster_overlaps(clusterings, cluster_nodes)
+		similarity_models = {}
+		similarity_models['jaccard'] = self._create_similarity_map(cluster_nodes, overlaps, similarity_name='J', similarity=jaccard_of_overlap, constrain=similarity_constrain)
+		similarity_models['f-measure'] = self._create_similarity_map(cluster_nodes, overlaps, similarity_name='F', similarity=f_measure_of_overlap, constrain=similarity_constrain)
+		similarity_models['inclusion'] = self._create_similarity_map(cluster_nodes, overlaps, similarity_name='I', similarity=inclusion_of_overlap, constrain=similarity_constrain)
+		return similarity_models
 
-	def _split_names_to_parts(self, name_of_nodes):
+	def _name_part_ids(self, name_of_nodes):
+		tokens = self._name_tokens()
 		names = [name.replace('.', '/').replace(self._most_common, '') for name in name_of_nodes]
 		common = _longest_substr(names)
-		names = [n.replace(common, '') for n in names]
-		parted = [[pp for pp in [re.sub(r'\W', '', p) for p in re.sub( r'([A-Z]|\W)', r' \1', n).split()] if not (pp == '' or re.search(r'([tT]est|Lorg)', pp))] for n in names]
-		return parted
+		return [tokens.ids_of(n.replace(common, '')) for n in names]
+
+	def _name_tokens(self):
+		if not hasattr(self, '_tokens'):
+			self._tokens = _NameTokens()
+		return self._tokens
 
 	def _most_common_parts(self, name_of_nodes, count=10):
-		names_parts = self._split_names_to_parts(name_of_nodes)
-		counts = {}
-		for name in names_parts:
-			checked = set()
-			for part in name:
-				if part not in checked and len(part) > 1:
-					counts[part] = counts.get(part, 0) + 1
-		sorted_counts = [part[0] for part in sorted(counts.items(), key=lambda x: x[1], reverse=True)]
-		return sorted_counts[:count]
+		"""The parts longer than one character by descending number of occurrences, ties in order of first occurrence."""
+		tokens = self._name_tokens()
+		part_ids = np.fromiter((token_id for token_ids in self._name_part_ids(name_of_nodes) for token_id in token_ids), dtype=np.int64)
+		part_ids = part_ids[tokens.is_long(part_ids)]
+		ids, first, counts = np.unique(part_ids, return_index=True, return_counts=True)
+		order = np.lexsort((first, -counts))[:count]
+		return [tokens.token(token_id) for token_id in ids[order].tolist()]
 
 	def _suggest_name(self, test_names, code_names):
 		_test_names = [name.replace('.', '/').replace(self._most_common, '*') for name in test_names]
@@ -199,25 +415,62 @@ class CoverageBasedData(object):
 		test_summary = '\n'.join(chunks_of(' '.join(self._most_common_parts(_test_names)), 40))
 		return 'code "%s"\nalso: %s etc.\ntested by\ntest "%s"\nalso: %s etc.\ncontaining %d codes, %d tests' % (code_suggested_name, code_summary, test_suggested_name, test_summary, len(_code_names), len(_test_names))
 
-	def _create_similarity_map(self, dir, clusterings, similarity_name=None, similarity=lambda a, b: 0, constrain=lambda v: v):
-		merged_model = nx.DiGraph()
-		global_cluster_index = 0
-		for clustering_index, clustering in enumerate(clusterings):
+	def _cluster_nodes(self, clusterings):
+		"""Attributes of the similarity model nodes, one per cluster of every clustering, numbered globally."""
+		cluster_nodes = []
+		for clustering in clusterings:
 			for cluster, content in clustering.clusters.items():
 				code_names = [clustering.name_of(node) for node in content if clustering.domain_of(node) == 'code']
 				test_names = [clustering.name_of(node) for node in content if clustering.domain_of(node) == 'test']
 				suggested_name = self._suggest_name(test_names=test_names, code_names=code_names)
-				merged_model.add_node(global_cluster_index, id=cluster, clustering=clustering.key, node_count=len(content), suggested_name=suggested_name)
-				global_cluster_index += 1
-		for cluster_i, data_i in merged_model.nodes(data=True):
-			for cluster_j, data_j in merged_model.nodes(data=True):
-				if data_i['clustering'] != data_j['clustering'] and cluster_i != cluster_j:
-					content_i = [c.clusters[str(data_i['id'])] for c in clusterings if c.key == data_i['clustering']][0]
-					content_j = [c.clusters[str(data_j['id'])] for c in clusterings if c.key == data_j['clustering']][0]
-					similarity_value = similarity(content_i, content_j)
-					if constrain(similarity_value):
-						merged_model.add_edge(cluster_i, cluster_j, similarity=similarity_value, label='%s = %.2f' % (similarity_name, similarity_value))
-		nx.write_graphml(merged_model, os.path.join(dir,'similarity.model_%s.graphml' % similarity_name))
-		return merged_model
+				cluster_nodes.append(dict(id=cluster, clustering=clustering.key, node_count=len(content), suggested_name=suggested_name))
+		return cluster_nodes
+
+	def _cluster_overlaps(self, clusterings, cluster_nodes):
+		"""Node counts shared by the model nodes of different clusterings, only for the pairs that share any.
+
+		The contents of a model node are looked up in the first clustering with its key, and the overlaps
+		come from the sparse contingency table of every two such clusterings.
+		Returns the size of every model node and a {(i, j): overlap} dict.
+		"""
+		clustering_of_key = {}
+		for clustering in clusterings:
+			clustering_of_key.setdefault(clustering.key, clustering)
+		model_nodes_of = {}
+		sizes = []
+		for index, data in enumerate(cluster_nodes):
+			model_nodes_of.setdefault((data['clustering'], str(data['id'])), []).append(index)
+			sizes.append(len(clustering_of_key[data['clustering']].clusters[str(data['id'])]))
+		overlaps = {}
+		keys = list(clustering_of_key)
+		for key_index, key_i in enumerate(keys):
+			for key_j in keys[key_index + 1:]:
+				clustering_i, clustering_j = clustering_of_key[key_i], clustering_of_key[key_j]
+				table = ContingencyTable(clustering_i, clustering_j, list(clustering_i.base_set & clustering_j.base_set))
+				for cluster_i, cluster_j, overlap in table.cells():
+					for i in model_nodes_of.get((key_i, str(cluster_i)), []):
+						for j in model_nodes_of.get((key_j, str(cluster_j)), []):
+							overlaps[(i, j)] = overlap
+							overlaps[(j, i)] = overlap
+		return sizes, overlaps
+
+	def _create_similarity_map(self, cluster_nodes, overlaps, similarity_name=None, similarity=lambda overlap, size_i, size_j: 0, constrain=lambda v: v):
+		"""Similarity model of the clusters: an edge for every pair from different clusterings whose similarity passes the constrain.
+
+		Pairs without common nodes are only checked when a zero similarity could pass the constrain.
+		"""
+		sizes, overlaps = overlaps
+		if constrain(similarity(0, 1, 1)):
+			pairs = [(i, j) for i in range(len(cluster_nodes)) for j in range(len(cluster_nodes)) if cluster_nodes[i]['clustering'] != cluster_nodes[j]['clustering']]
+		else:
+			pairs = sorted(overlaps)
+		sources, targets, similarities = [], [], []
+		for i, j in pairs:
+			similarity_value = similarity(overlaps.get((i, j), 0), sizes[i], sizes[j])
+			if constrain(similarity_value):
+				sources.append(i)
+				targets.append(j)
+				similarities.append(similarity_value)
+		return SimilarityGraph(similarity_name, [data['id'] for data in cluster_nodes], [data['clustering'] for data in cluster_nodes], [data['node_count'] for data in cluster_nodes], [data['suggested_name'] for data in cluster_nodes], sources, targets, similarities)
 
 print("coverage_cluster.algorithm was loaded.")
@@ -0,0 +1,90 @@
+import argparse
+import contextlib
+import multiprocessing
+import os
+import time
+import traceback
+
+from main import *
+
+parser = argparse.ArgumentParser(description = 'ILYA Test Clustering of many projects')
+parser.add_argument('-m', '--manifest', required = True, help = 'csv file of coverage;labels;direct[;type] lines, one project per line')
+parser.add_argument('-o', '--output', default = 'batch-summary.csv', help = 'the consolidated summary of all projects')
+parser.add_argument('-p', '--processes', type = int, default = multiprocessing.cpu_count(), help = 'number of projects analyzed at once')
+parser.add_argument('--export', nargs = '+', choices = ['graphml', 'binary', 'none'], default = ['graphml'], help = 'formats of the exported similarity models')
+parser.add_argument('--louvain', choices = ['external', 'builtin'], default = 'external', help = 'run the bundled louvain binaries or the built-in implementation')
+parser.add_argument('--metrics', nargs = '+', choices = list(METRICS), default = None, help = 'compute and save only these comparison metrics')
+parser.add_argument('--no-cache', action = 'store_true', help = 'compute every stage without the stage cache')
+
+
+def read_manifest(manifest_path):
+	"""Projects of the manifest as (coverage, labels, direct calls, test type) tuples, paths relative to the manifest."""
+	base_dir = os.path.dirname(os.path.abspath(manifest_path))
+	projects = []
+	with open(manifest_path, 'r') as manifest:
+		for line in manifest:
+			line = line.strip()
+			if not line or line.startswith('#'):
+				continue
+			parts = [part.strip() for part in line.split(';')]
+			if len(parts) not in (3, 4):
+				raise Exception("Manifest line should be coverage;labels;direct[;type] (%s)" % line)
+			coverage, labels, direct = (os.path.join(base_dir, path) for path in parts[:3])
+			if not os.path.isfile(coverage):
+				raise Exception("Coverage file of the manifest cannot be found (%s)" % coverage)
+			projects.append((coverage, labels, direct, parts[3] if len(parts) == 4 else 'unit'))
+	return projects
+
+def _label_index_of(labels_dir, index_dir):
+	return os.path.join(index_dir, '%s.labels.idx' % hash_it(os.path.abspath(labels_dir)))
+
+def _analyze_project(task):
+	(coverage, labels, direct, test_type), options = task
+	started = time.time()
+	with open('%s.log' % coverage[:-4], 'w') as log, contextlib.redirect_stdout(log):
+		try:
+			summary = analyze(coverage, labels, direct, test_type=test_type, **options)
+			summary['status'] = 'ok'
+		except Exception:
+			traceback.print_exc(file=log)
+			summary = {'name': os.path.splitext(os.path.basename(coverage))[0], 'status': 'failed'}
+	summary['coverage'] = coverage
+	summary['seconds'] = time.time() - started
+	return summary
+
+def run_batch(projects, index_dir, processes=1, **options):
+	"""Analyze the projects with a pool of processes, the largest coverage files first.
+
+	The label index of every labels directory is built once in index_dir before the pool starts, and the workers only read it.
+	Every project logs into a .log file next to its coverage file; the summaries are returned in manifest order.
+	"""
+	os.makedirs(index_dir, exist_ok=True)
+	for labels_dir in sorted(set(labels for _, labels, _, _ in projects)):
+		build_label_index(labels_dir, _label_index_of(labels_dir, index_dir))
+
+	order = sorted(range(len(projects)), key=lambda index: os.path.getsize(projects[index][0]), reverse=True)
+	tasks = [(projects[index], dict(options, label_index=_label_index_of(projects[index][1], index_dir))) for index in order]
+	summaries = [None] * len(projects)
+	with multiprocessing.Pool(max(1, min(processes, len(projects)))) as pool:
+		for index, summary in zip(order, pool.imap(_analyze_project, tasks, chunksize=1)):
+			print("%s: %s in %.1f s" % (summary['name'], summary['status'], summary['seconds']))
+			summaries[index] = summary
+	return summaries
+
+def save_summary(path, summaries, metrics=None):
+	"""One line per project, named by its coverage file, with the metrics of both comparisons and the smell counts."""
+	metrics = list(METRICS) if metrics is None else metrics
+	columns = ['%s %s' % (direction, metric) for direction in ('declared-detected', 'detected-declared') for metric in metrics]
+	with open(path, 'w') as summary_file:
+		summary_file.write('project;status;seconds;%s;alter egos;clean cuts;smells\n' % ';'.join(columns))
+		for summary in summaries:
+			values = ['%f' % summary[direction][metric] if direction in summary else '' for direction in ('declared-detected', 'detected-declared') for metric in metrics]
+			values += ['%d' % summary[count] if count in summary else '' for count in ('alter egos', 'clean cuts', 'smells')]
+			summary_file.write('%s;%s;%.3f;%s\n' % (os.path.relpath(summary['coverage'], os.path.dirname(os.path.abspath(path))), summary['status'], summary['seconds'], ';'.join(values)))
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+	projects = read_manifest(args.manifest)
+	summaries = run_batch(projects, os.path.join(os.path.dirname(os.path.abspath(args.output)), 'labels-indexes'), processes=args.processes, export=[model_format for model_format in args.export if model_format != 'none'], louvain_engine=args.louvain, metrics=args.metrics, use_cache=not args.no_cache)
+	save_summary(args.output, summaries, metrics=args.metrics)
+	print("Summary of %d projects saved to %s" % (len(summaries), args.output))
@@ -0,0 +1,176 @@
+import argparse
+import collections
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+from algorithm import *
+from smell import *
+
+SCALES = collections.OrderedDict([
+	('small', dict(tests=200, methods=1000, density=.02, communities=10)),
+	('medium', dict(tests=1000, methods=5000, density=.01, communities=40)),
+	('large', dict(tests=3000, methods=15000, density=.005, communities=120)),
+])
+STAGES = ('ingestion', 'community detection', 'c-confidence', 'declared clustering', 'p-confidence', 'comparator', 'similarity models', 'sniffer')
+
+
+def generate(directory, tests, methods, density, communities, mislabelled=.05, in_community=.9, calls_per_test=5, seed=0):
+	"""Write a synthetic SoDA coverage matrix, labels directory and direct call file with planted communities.
+
+	Tests and methods are put into random communities, every test covers about density of the methods, most of
+	them from its own community. The package of a method is its community, except for the mislabelled fraction
+	swapped by change_mapping. Returns the paths of the coverage file, the labels directory and the direct calls.
+	"""
+	random.seed(seed)
+	generator = np.random.RandomState(seed)
+	method_community = random_cluster_mapping(methods, communities)
+	test_community = random_cluster_mapping(tests, communities)
+	method_package = change_mapping(method_community, int(mislabelled * methods))
+	members = collections.defaultdict(list)
+	for method, community in method_community.items():
+		members[community].append(method)
+	members = {community: np.array(methods_of_community) for community, methods_of_community in members.items()}
+	method_names = ['org.bench.pkg%d.Class%d.method%d()V' % (method_package[method], method // 10, method) for method in range(methods)]
+	test_names = ['org.bench.pkg%d.test.Test%d.test%d()V' % (test_community[test], test // 10, test) for test in range(tests)]
+
+	os.makedirs(os.path.join(directory, 'labels'), exist_ok=True)
+	coverage_path = os.path.join(directory, 'bench.csv')
+	labels_dir = os.path.join(directory, 'labels')
+	direct_calls_path = os.path.join(directory, 'direct.csv')
+	template = np.frombuffer(b';0' * methods, dtype=np.uint8)
+	with open(coverage_path, 'wb') as coverage, open(direct_calls_path, 'w') as direct_calls:
+		coverage.write((';%s\n' % ';'.join(method_names)).encode('utf-8'))
+		for test in range(tests):
+			covered_count = max(1, generator.binomial(methods, density))
+			own = members.get(test_community[test], np.zeros(0, dtype=np.int64))
+			own_count = min(generator.binomial(covered_count, in_community), len(own))
+			covered = np.unique(np.concatenate((generator.choice(own, own_count, replace=False) if own_count else own[:0], generator.randint(0, methods, covered_count - own_count))))
+			row = template.copy()
+			row[2 * covered + 1] = ord('1')
+			coverage.write(test_names[test].encode('utf-8') + row.tobytes() + b'\n')
+			for method in generator.choice(covered, min(calls_per_test, len(covered)), replace=False).tolist():
+				direct_calls.write('%s;%s\n' % (test_names[test], method_names[method]))
+	with open(os.path.join(labels_dir, 'labels.csv'), 'w') as labels:
+		labels.write(''.join('%s;x;pkg%d\n' % (name, method_package[method]) for method, name in enumerate(method_names)))
+		labels.write(''.join('%s;x;pkg%d\n' % (name, test_community[test]) for test, name in enumerate(test_names)))
+	return coverage_path, labels_dir, direct_calls_path
+
+def _run_stages(coverage_path, labels_dir, direct_calls_path, engine, measure):
+	base_name = os.path.splitext(coverage_path)[0]
+	if os.path.isfile('%s.labels.idx' % base_name):
+		os.remove('%s.labels.idx' % base_name)
+	coverage = measure('ingestion', lambda: CoverageBasedData(coverage_path, regenerate_edge_list=True))
+	detected = measure('community detection', lambda: coverage.community_based_clustering(name='bench-detected', regenerate_external_data=True, engine=engine))
+	measure('c-confidence', lambda: detected.calculate_c_confidence(edges=coverage.edge_arrays()))
+	declared = measure('declared clustering', lambda: coverage.package_based_clustering(name='bench-declared', labels_dir=labels_dir))
+	measure('p-confidence', lambda: declared.calculate_p_confidence(direct_calls_path))
+	measure('comparator', lambda: (lambda comparison: (comparison.metrics(), comparison.reverse().metrics()))(declared.compare_to(detected)))
+	models = measure('similarity models', lambda: coverage.build_similarity_models([detected, declared], similarity_constrain=lambda v: v > 0))
+	measure('sniffer', lambda: Sniffer(models, declared, detected, 'unit', 0.0, 0.0))
+
+def _run_scale(task):
+	"""Time the stages of one scale in a fresh process, then measure their memory in one more, traced run.
+
+	The wall time is the best of the repeats, the peak memory of a stage is the peak of the memory allocated
+	while it ran (as traced by tracemalloc, which NumPy reports to) and peak_rss is the peak of the whole process.
+	"""
+	paths, repeat, engine = task
+	results = collections.OrderedDict((stage, dict(seconds=float('inf'), peak_memory=0)) for stage in STAGES)
+
+	def timed(stage, compute):
+		started = time.perf_counter()
+		value = compute()
+		results[stage]['seconds'] = min(results[stage]['seconds'], time.perf_counter() - started)
+		return value
+
+	def traced(stage, compute):
+		tracemalloc.reset_peak()
+		start = tracemalloc.get_traced_memory()[0]
+		value = compute()
+		results[stage]['peak_memory'] = tracemalloc.get_traced_memory()[1] - start
+		return value
+
+	with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+		for _ in range(repeat):
+			_run_stages(*paths, engine, timed)
+		tracemalloc.start()
+		try:
+			_run_stages(*paths, engine, traced)
+		finally:
+			tracemalloc.stop()
+	return results, peak_memory()
+
+def run_benchmark(scales, work_dir, repeat=3, engine='builtin', seed=0):
+	"""Results of the given scales: the best wall time of the repeats and the peak memory of every stage, each scale run in its own process."""
+	results = collections.OrderedDict()
+	results['python'] = sys.version.split()[0]
+	results['numpy'] = np.__version__
+	results['repeat'] = repeat
+	results['engine'] = engine
+	results['scales'] = collections.OrderedDict()
+	for scale in scales:
+		paths = generate(os.path.join(work_dir, scale), seed=seed, **SCALES[scale])
+		with multiprocessing.get_context('fork').Pool(1) as pool:
+			stages, peak_rss = pool.apply(_run_scale, ((paths, repeat, engine),))
+		results['scales'][scale] = collections.OrderedDict([('parameters', SCALES[scale]), ('peak_rss', peak_rss), ('stages', stages)])
+		for stage, measured in stages.items():
+			print("%s %s: %.3f s, peak memory %.1f MB" % (scale, stage, measured['seconds'], measured['peak_memory'] / 2 ** 20))
+		print("%s: peak RSS %.1f MB" % (scale, peak_rss / 2 ** 20))
+	return results
+
+def regressions_of(results, baseline, tolerance=.2, min_seconds=.05, min_memory=2 ** 20):
+	"""The (scale, stage, measure, baseline value, value) of the stages slower or bigger than the baseline by more than the tolerance.
+
+	Stages below min_seconds or min_memory bytes in both runs are ignored for that measure, it is mostly noise there.
+	"""
+	regressions = []
+	for scale, measured in results['scales'].items():
+		baseline_stages = baseline.get('scales', {}).get(scale, {}).get('stages', {})
+		for stage, values in measured['stages'].items():
+			if stage not in baseline_stages:
+				continue
+			for measure, minimum in (('seconds', min_seconds), ('peak_memory', min_memory)):
+				before, after = baseline_stages[stage][measure], values[measure]
+				if max(before, after) >= minimum and after > before * (1 + tolerance):
+					regressions.append((scale, stage, measure, before, after))
+	return regressions
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'ILYA pipeline benchmark on synthetic data')
+	parser.add_argument('--scales', nargs = '+', choices = list(SCALES), default = ['small', 'medium'], help = 'the data sizes to run')
+	parser.add_argument('--repeat', type = int, default = 3, help = 'runs of every scale, the best time is recorded')
+	parser.add_argument('-o', '--output', default = 'benchmark-results.json', help = 'the results file')
+	parser.add_argument('--baseline', default = None, help = 'results file of an earlier run to compare with')
+	parser.add_argument('--tolerance', type = float, default = .2, help = 'relative slowdown flagged as a regression')
+	parser.add_argument('--louvain', choices = ['external', 'builtin'], default = 'builtin', help = 'community detection engine')
+	parser.add_argument('--seed', type = int, default = 0, help = 'seed of the synthetic data')
+	parser.add_argument('--work-dir', default = None, help = 'keep the generated data in this directory')
+	args = parser.parse_args()
+
+	work_dir = args.work_dir or tempfile.mkdtemp(prefix='ilya-benchmark-')
+	try:
+		results = run_benchmark(args.scales, work_dir, repeat=args.repeat, engine=args.louvain, seed=args.seed)
+	finally:
+		if args.work_dir is None:
+			shutil.rmtree(work_dir)
+	with open(args.output, 'w') as output:
+		json.dump(results, output, indent=2)
+	print("Results saved to %s" % args.output)
+
+	if args.baseline:
+		with open(args.baseline, 'r') as baseline_file:
+			regressions = regressions_of(results, json.load(baseline_file), tolerance=args.tolerance)
+		for scale, stage, measure, before, after in regressions:
+			print("Regression: %s %s %s is %g instead of %g" % (scale, stage, measure, after, before))
+		if regressions:
+			sys.exit(1)
+		print("No regressions against %s" % args.baseline)
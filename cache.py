@@ -0,0 +1,78 @@
+import hashlib
+import os
+import pickle
+
+# bump when a stage output or a cached object changes
+CACHE_VERSION = 2
+
+
+class StageCache(object):
+	"""Pickled results of the pipeline stages, the least recently used evicted beyond max_bytes."""
+	def __init__(self, directory, max_bytes=1024 * 2 ** 20, enabled=True):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.enabled = enabled
+		if enabled:
+			os.makedirs(directory, exist_ok=True)
+
+	def key(self, stage, *parts):
+		"""Key of a stage and its inputs, None (never cached) when any input is None."""
+		if any(part is None for part in parts):
+			return None
+		digest = hashlib.sha256(repr((CACHE_VERSION, stage) + parts).encode('utf-8'))
+		return '%s-%s' % (stage, digest.hexdigest()[:32])
+
+	def _path(self, key):
+		return os.path.join(self.directory, '%s.pickle' % key)
+
+	def get(self, key):
+		"""Return (True, value) for a cached key and (False, None) otherwise."""
+		if not self.enabled or key is None or not os.path.isfile(self._path(key)):
+			return False, None
+		path = self._path(key)
+		try:
+			with open(path, 'rb') as entry:
+				value = pickle.load(entry)
+		except (EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+			os.remove(path)
+			return False, None
+		os.utime(path)
+		return True, value
+
+	def put(self, key, value):
+		if not self.enabled or key is None:
+			return
+		path = self._path(key)
+		with open('%s.tmp' % path, 'wb') as entry:
+			pickle.dump(value, entry, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace('%s.tmp' % path, path)
+		self._evict(keep=path)
+
+	def stage(self, key, compute):
+		"""The cached value of the key, or the value computed, cached and returned by compute()."""
+		hit, value = self.get(key)
+		if hit:
+			print("Stage %s is cached" % key)
+			return value
+		value = compute()
+		self.put(key, value)
+		return value
+
+	def _evict(self, keep=None):
+		entries = []
+		for name in os.listdir(self.directory):
+			path = os.path.join(self.directory, name)
+			if name.endswith('.pickle') and os.path.isfile(path):
+				stat = os.stat(path)
+				entries.append((stat.st_mtime, stat.st_size, path))
+		total = sum(size for _, size, _ in entries)
+		for _, size, path in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			if path != keep:
+				os.remove(path)
+				total -= size
+		if total > self.max_bytes and keep is not None:
+			os.remove(keep)
+
+print("coverage_cluster.cache was loaded.")
@@ -1,10 +1,12 @@
 import collections
+import functools
 import hashlib
 import math
 import os
 import pdb
 import random
 import shutil
+import numpy as np
 
 
 Result = collections.namedtuple('Result', 'cluster '
@@ -17,6 +19,17 @@ Result = collections.namedtuple('Result', 'cluster '
                                           'confidence')
 
 
+METRICS = collections.OrderedDict([
+	('chi_squared_coefficient', 'Chi Squared coefficient'),
+	('rand_index', 'Rand index'),
+	('fowlkes_mallows_index', 'Fowlkes-Mallows index'),
+	('jaccard_index', 'Jaccard index'),
+	('mirkin_metric', 'Mirkin metric'),
+	('f_measure', 'F-measure'),
+])
+SYMMETRIC_METRICS = {'chi_squared_coefficient', 'rand_index', 'jaccard_index', 'mirkin_metric'}
+
+
 def chunks_of(l, n):
 	"""Yield successive n-sized chunks from l."""
 	for i in range(0, len(l), n):
@@ -39,6 +52,51 @@ def change_mapping(base, switch_count):
 		modified[x], modified[y] = modified[y], modified[x]
 	return modified
 
+def _pairs(count):
+	return count * (count - 1) // 2
+
+def _memoized_metric(metric):
+	"""Compute a comparator metric on first access only; symmetric metrics are shared with the reversed comparator."""
+	@functools.wraps(metric)
+	def cached(self):
+		cache = self._symmetric_metrics if metric.__name__ in SYMMETRIC_METRICS else self._metrics
+		if metric.__name__ not in cache:
+			cache[metric.__name__] = metric(self)
+		return cache[metric.__name__]
+	return cached
+
+class _Interner(object):
+	"""Dense integer ids of strings in order of first appearance."""
+	def __init__(self):
+		self._ids = {}
+
+	def id_of(self, name):
+		name_id = self._ids.get(name)
+		if name_id is None:
+			name_id = self._ids[name] = len(self._ids)
+		return name_id
+
+	def __len__(self):
+		return len(self._ids)
+
+def _csr_of_pairs(rows, columns, row_count, column_count):
+	"""CSR (indptr, indices) of the distinct (row, column) pairs, columns sorted within each row."""
+	keys = np.unique(np.asarray(rows, dtype=np.int64) * column_count + np.asarray(columns, dtype=np.int64))
+	indptr = np.zeros(row_count + 1, dtype=np.int64)
+	np.cumsum(np.bincount(keys // column_count if column_count else keys, minlength=row_count), out=indptr[1:])
+	return indptr, keys % column_count if column_count else keys
+
+def _csr_positions(indptr, rows):
+	"""Positions of the entries of the given CSR rows, row after row."""
+	starts = indptr[rows]
+	lengths = indptr[rows + 1] - starts
+	offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+	return offsets + np.arange(int(lengths.sum()))
+
+def _pair_sum(counts):
+	counts = np.asarray(counts, dtype=np.int64)
+	return int(np.sum(counts * (counts - 1) // 2))
+
 def _mapping_to_clustering(mapping):
 	clusters = {}
 	for item, cluster in mapping.items():
@@ -64,9 +122,13 @@ class Clustering(object):
 			self.size_of[i] = len(cluster)
 
 	def name_of(self, node):
+		if hasattr(self.data, 'name_of'):
+			return self.data.name_of(node)
 		return self.data[node].get('name', 'noname')
 
 	def domain_of(self, node):
+		if hasattr(self.data, 'domain_of'):
+			return self.data.domain_of(node)
 		return self.data[node].get('domain', 'unknown')
 
 	def save(self, filename):
@@ -94,33 +156,45 @@ class Clustering(object):
 	def compare_to(self, other):
 		return ClusteringComparator(self, other)
 
-	def calculate_c_confidence(self, edge_list_path):
+	def calculate_c_confidence(self, edge_list_path=None, edges=None):
 		if self.key != 'community_cluster':
 			raise Exception("Trying to calculate C-confidence on a not community-based clustering")
 
-		self.confidence = dict()
-		good_edges = {k: 0 for k in self.clusters.keys()}
-		bad_edges = {k: 0 for k in self.clusters.keys()}
-
-		with open(edge_list_path, 'r') as edge_list_file:
-			for line in edge_list_file:
-				parts = line.strip().split(' ')
-				assert len(parts) == 2
-
-				from_edge = parts[0]
-				to_edge = parts[1]
-
-				for cluster_id, edge_set in self.clusters.items():
-					if from_edge in edge_set:
-						if to_edge in self.clusters[cluster_id]:
-							good_edges[cluster_id] = good_edges.get(cluster_id, 0) + 1
-							good_edges['global'] = good_edges.get('global', 0) + 1
-						else:
-							bad_edges[cluster_id] = bad_edges.get(cluster_id, 0) + 1
-							bad_edges['global'] = bad_edges.get('global', 0) + 1
+		if edges is None:
+			edges = np.loadtxt(edge_list_path, dtype=np.int64, ndmin=2).reshape(-1, 2).T
+		self.set_c_confidence(*self.c_confidence_counts(*edges))
+
+	def c_confidence_counts(self, sources, targets):
+		"""Edges starting from each cluster that stay inside it (good) and that leave it (bad), as two dicts."""
+		sources = np.asarray(sources, dtype=np.int64)
+		targets = np.asarray(targets, dtype=np.int64)
+		cluster_ids = list(self.clusters.keys())
+		index_of_cluster = {cluster_id: index for index, cluster_id in enumerate(cluster_ids)}
+		node_count = max([int(node) for node in self.mapping] + [int(sources.max()) if len(sources) else 0, int(targets.max()) if len(targets) else 0]) + 1
+		cluster_of = np.full(node_count, -1, dtype=np.int64)
+		for node, cluster_id in self.mapping.items():
+			cluster_of[int(node)] = index_of_cluster[cluster_id]
+
+		from_cluster = cluster_of[sources]
+		covered = from_cluster >= 0
+		is_good = covered & (from_cluster == cluster_of[targets])
+		good_counts = np.bincount(from_cluster[is_good], minlength=len(cluster_ids)).tolist()
+		bad_counts = np.bincount(from_cluster[covered & ~is_good], minlength=len(cluster_ids)).tolist()
+		return dict(zip(cluster_ids, good_counts)), dict(zip(cluster_ids, bad_counts))
+
+	def set_c_confidence(self, good_edges, bad_edges):
+		"""Set the C-confidence of the clusters from the good and bad edge counts of c_confidence_counts."""
+		self.edge_counts = (dict(good_edges), dict(bad_edges))
+		good_edges = {cluster_id: good_edges.get(cluster_id, 0) for cluster_id in self.clusters}
+		bad_edges = {cluster_id: bad_edges.get(cluster_id, 0) for cluster_id in self.clusters}
+		if sum(good_edges.values()) > 0:
+			good_edges['global'] = sum(good_edges.values())
+		if sum(bad_edges.values()) > 0:
+			bad_edges['global'] = sum(bad_edges.values())
 
+		self.confidence = dict()
 		for cluster_id, num_good_edges in good_edges.items():
-			num_all_edges = num_good_edges + bad_edges[cluster_id]
+			num_all_edges = num_good_edges + bad_edges.get(cluster_id, 0)
 			confidence = num_good_edges / num_all_edges if num_all_edges > 0 else 0
 			self.confidence[cluster_id] = confidence
 
@@ -128,49 +202,51 @@ class Clustering(object):
 		if self.key != 'declared_cluster':
 			raise Exception("Trying to calculate P-confidence on a not package-based clustering")
 
-		methods = set([item['name'] for _, item in self.data.items() if item['domain'] == 'code'])
-
-		direct_calls = dict()
-
+		# names are interned to integer ids: tests and methods of the data first, then those only found in the direct calls
+		test_ids = _Interner()
+		method_ids = _Interner()
+		test_of_node = {}
+		method_of_node = {}
+		for node in self.data:
+			if self.domain_of(node) == 'test':
+				test_of_node[node] = test_ids.id_of(self.name_of(node))
+			elif self.domain_of(node) == 'code':
+				method_of_node[node] = method_ids.id_of(self.name_of(node))
+		known_method_count = len(method_ids)
+
+		calling_tests = []
+		called_methods = []
 		with open(direct_calls_path, 'r') as direct_calls_file:
 			for line in direct_calls_file:
 				parts = line.strip().split(';')
 				assert len(parts) == 2
 
-				test = parts[0]
-				method = parts[1]
-
-				if not test in direct_calls:
-					direct_calls[test] = set()
+				calling_tests.append(test_ids.id_of(parts[0]))
+				called_methods.append(method_ids.id_of(parts[1]))
 
-				direct_calls[test].add(method)
+		indptr, called = _csr_of_pairs(calling_tests, called_methods, len(test_ids), len(method_ids))
+		has_calls = np.diff(indptr) > 0
+		in_cluster = np.zeros(len(method_ids), dtype=np.int64)
 
 		results = list()
 
-		for cluster, members in self.clusters.items():
-			tests_in_cluster = set([self.data[m]['name'] for m in members if self.data[m]['domain'] == 'test'])
-			methods_in_cluster = set([self.data[m]['name'] for m in members if self.data[m]['domain'] == 'code'])
+		for stamp, (cluster, members) in enumerate(self.clusters.items(), 1):
+			tests_in_cluster = np.unique(np.fromiter((test_of_node[m] for m in members if m in test_of_node), dtype=np.int64))
+			methods_in_cluster = np.unique(np.fromiter((method_of_node[m] for m in members if m in method_of_node), dtype=np.int64))
+			in_cluster[methods_in_cluster] = stamp
 
-			called_methods = set()
-			tests_not_matched = set()
+			tests_matched = tests_in_cluster[has_calls[tests_in_cluster]]
+			called_methods = np.unique(called[_csr_positions(indptr, tests_matched)])
+			matched_called_methods = called_methods[called_methods < known_method_count]
 
-			for test in tests_in_cluster:
-				if test in direct_calls:
-					called_methods |= direct_calls[test]
-				else:
-					tests_not_matched.add(test)
-
-			matched_called_methods = called_methods & methods
-			called_in_cluster = matched_called_methods & methods_in_cluster
-
-			n = len(called_in_cluster)
+			n = int(np.count_nonzero(in_cluster[matched_called_methods] == stamp))
 			m = len(matched_called_methods)
 			c = n / m if m > 0 else 0
 
 			r = Result(
 				cluster=cluster,
 				tests_in_cluster=len(tests_in_cluster),
-				tests_in_cluster_nm=len(tests_not_matched),
+				tests_in_cluster_nm=len(tests_in_cluster) - len(tests_matched),
 				methods_in_cluster=len(methods_in_cluster),
 				called_methods=len(called_methods),
 				called_methods_nm=len(called_methods) - m,
@@ -204,88 +280,229 @@ class Clustering(object):
 		return self.confidence.get(cluster, 0)
 
 
+class ClusteringHierarchy(object):
+	"""Nested clusterings of the same nodes, from the finest level to coarser and coarser ones.
+
+	Clusters are integer coded at every level in order of first appearance among the nodes and
+	parents[level] maps each cluster of a level to its cluster on the next, coarser level.
+	"""
+	def __init__(self, name, key, data, nodes, codes, labels, parents):
+		self.name = name
+		self.key = key
+		self.data = data
+		self.nodes = nodes
+		self.codes = codes
+		self.labels = labels
+		self.parents = parents
+		self._clusterings = {}
+
+	def levels(self):
+		return range(len(self.labels))
+
+	def codes_at(self, level):
+		codes = self.codes
+		for parents in self.parents[:level]:
+			codes = parents[codes]
+		return codes
+
+	def clustering(self, level):
+		if level not in self._clusterings:
+			labels = self.labels[level]
+			mapping = {node: labels[code] for node, code in zip(self.nodes, self.codes_at(level).tolist())}
+			self._clusterings[level] = Clustering(mapping, '%s-%d' % (self.name, level), self.key, self.data)
+		return self._clusterings[level]
+
+	def compare_to(self, other):
+		"""Comparators of every level to the other clustering, the coarser confusion matrices merged from the finest one."""
+		comparators = collections.OrderedDict()
+		table = None
+		for level in self.levels():
+			if table is None:
+				comparator = self.clustering(level).compare_to(other)
+			else:
+				table = table.merge_rows(self.parents[level - 1], list(self.labels[level]))
+				comparator = ClusteringComparator(self.clustering(level), other, confusion_matrix=table)
+			table = comparator.confusion_matrix
+			comparators[level] = comparator
+		return comparators
+
+
+class ContingencyTable(object):
+	"""Sparse confusion matrix of two clusterings over integer-coded cluster labels.
+
+	Rows and columns follow the cluster order of the clusterings, only the non-zero cells are stored
+	as parallel (row, column, count) arrays in row-major order.
+	"""
+	def __init__(self, clustering_i, clustering_j, nodes):
+		self.rows = list(clustering_i.clusters)
+		self.columns = list(clustering_j.clusters)
+		row_of_cluster = {cluster: index for index, cluster in enumerate(self.rows)}
+		column_of_cluster = {cluster: index for index, cluster in enumerate(self.columns)}
+		mapping_i = clustering_i.mapping
+		mapping_j = clustering_j.mapping
+		row_labels = np.fromiter((row_of_cluster[mapping_i[node]] for node in nodes), dtype=np.int64, count=len(nodes))
+		column_labels = np.fromiter((column_of_cluster[mapping_j[node]] for node in nodes), dtype=np.int64, count=len(nodes))
+		cells, counts = np.unique(row_labels * len(self.columns) + column_labels, return_counts=True)
+		self.cell_rows = cells // len(self.columns) if self.columns else cells
+		self.cell_columns = cells - self.cell_rows * len(self.columns)
+		self.cell_counts = counts
+		self.row_sizes = np.array([clustering_i.size_of[cluster] for cluster in self.rows], dtype=np.int64)
+		self.column_sizes = np.array([clustering_j.size_of[cluster] for cluster in self.columns], dtype=np.int64)
+		self._row_major = True
+
+	@classmethod
+	def of_cells(cls, clustering_i, clustering_j, counts):
+		"""The table of two clusterings from a {(cluster i, cluster j): count} dict, zero cells are dropped."""
+		table = cls.__new__(cls)
+		table.rows = list(clustering_i.clusters)
+		table.columns = list(clustering_j.clusters)
+		row_of_cluster = {cluster: index for index, cluster in enumerate(table.rows)}
+		column_of_cluster = {cluster: index for index, cluster in enumerate(table.columns)}
+		cells = [(row_of_cluster[row] * len(table.columns) + column_of_cluster[column], count) for (row, column), count in counts.items() if count]
+		cells.sort()
+		table.cell_counts = np.array([count for _, count in cells], dtype=np.int64)
+		cells = np.array([cell for cell, _ in cells], dtype=np.int64)
+		table.cell_rows = cells // len(table.columns) if table.columns else cells
+		table.cell_columns = cells - table.cell_rows * len(table.columns)
+		table.row_sizes = np.array([clustering_i.size_of[cluster] for cluster in table.rows], dtype=np.int64)
+		table.column_sizes = np.array([clustering_j.size_of[cluster] for cluster in table.columns], dtype=np.int64)
+		table._row_major = True
+		return table
+
+	def merge_rows(self, parent_of_row, rows):
+		"""The table of a coarser row clustering, each of its rows summing the rows of its child clusters."""
+		merged = ContingencyTable.__new__(ContingencyTable)
+		merged.rows, merged.columns = rows, self.columns
+		parent_of_row = np.asarray(parent_of_row, dtype=np.int64)
+		cells, inverse = np.unique(parent_of_row[self.cell_rows] * len(self.columns) + self.cell_columns, return_inverse=True)
+		merged.cell_rows = cells // len(self.columns) if self.columns else cells
+		merged.cell_columns = cells - merged.cell_rows * len(self.columns)
+		merged.cell_counts = np.bincount(inverse, weights=self.cell_counts, minlength=len(cells)).astype(np.int64)
+		merged.row_sizes = np.bincount(parent_of_row, weights=self.row_sizes, minlength=len(rows)).astype(np.int64)
+		merged.column_sizes = self.column_sizes
+		merged._row_major = True
+		return merged
+
+	def transpose(self):
+		"""The same table with rows and columns swapped, sharing every array with this one."""
+		transposed = ContingencyTable.__new__(ContingencyTable)
+		transposed.rows, transposed.columns = self.columns, self.rows
+		transposed.cell_rows, transposed.cell_columns = self.cell_columns, self.cell_rows
+		transposed.cell_counts = self.cell_counts
+		transposed.row_sizes, transposed.column_sizes = self.column_sizes, self.row_sizes
+		transposed._row_major = False
+		return transposed
+
+	def _row_major_order(self):
+		if self._row_major:
+			return slice(None)
+		return np.argsort(self.cell_rows, kind='stable')
+
+	def row_sums(self):
+		return np.bincount(self.cell_rows, weights=self.cell_counts, minlength=len(self.rows)).astype(np.int64)
+
+	def column_sums(self):
+		return np.bincount(self.cell_columns, weights=self.cell_counts, minlength=len(self.columns)).astype(np.int64)
+
+	def dense_rows(self):
+		"""Yield every row of the full matrix as a list of counts, zeros included."""
+		order = self._row_major_order()
+		cell_rows, cell_columns, cell_counts = self.cell_rows[order], self.cell_columns[order], self.cell_counts[order]
+		bounds = np.searchsorted(cell_rows, np.arange(len(self.rows) + 1)).tolist()
+		for row in range(len(self.rows)):
+			line = [0] * len(self.columns)
+			for column, count in zip(cell_columns[bounds[row]:bounds[row + 1]].tolist(), cell_counts[bounds[row]:bounds[row + 1]].tolist()):
+				line[column] = count
+			yield line
+
+	def cells(self):
+		"""Yield the (row cluster, column cluster, count) triples of the non-zero cells."""
+		order = self._row_major_order()
+		for row, column, count in zip(self.cell_rows[order].tolist(), self.cell_columns[order].tolist(), self.cell_counts[order].tolist()):
+			yield self.rows[row], self.columns[column], count
+
+
 class ClusteringComparator():
-	def __init__(self, clustering_i, clustering_j):
+	def __init__(self, clustering_i, clustering_j, confusion_matrix=None):
 		if not clustering_i.compatible_with(clustering_j):
 			raise Exception('trying to compare incompatible clusters')
 		self._clustering_i = clustering_i
 		self._clustering_j = clustering_j
 		self.base_set = clustering_i.base_set | clustering_j.base_set
 		self.base_set_size = len(self.base_set)
-		self._init_confusion_matrix()
+		self._metrics = {}
+		self._symmetric_metrics = {}
+		self._reverse = None
+		self._init_confusion_matrix(confusion_matrix)
 		self._init_same_pairs()
 
-	def _init_confusion_matrix(self):
-		self.confusion_matrix = {}
-		for i, cluster_i in self._clustering_i.clusters.items():
-			self.confusion_matrix[i] = {}
-			for j, cluster_j in self._clustering_j.clusters.items():
-				self.confusion_matrix[i][j] = len(cluster_i & cluster_j)
+	def _init_confusion_matrix(self, confusion_matrix=None):
+		if confusion_matrix is None:
+			confusion_matrix = ContingencyTable(self._clustering_i, self._clustering_j, list(self.base_set))
+		self.confusion_matrix = confusion_matrix
 
 	def _init_same_pairs(self):
-		#self.same_pair = []
-		self.same_pair_count = 0
+		"""Count node pairs by co-membership from the confusion matrix instead of enumerating them."""
 		self.semisame_ij = []
-		self.semisame_ij_count = 0
 		self.semisame_ji = []
-		self.semisame_ji_count = 0
-		#self.unsame_pair = []
-		self.unsame_pair_count = 0
-		base_list = list(self.base_set)
-		i = 0
-		ps = pc = 5
-		n = sum(x for x in range(self.base_set_size))
+		n = _pairs(self.base_set_size)
 		print("base set size = %d\npairs = %d" % (self.base_set_size, n))
-		for a, node_a in enumerate(base_list):
-			for b, node_b in enumerate(base_list):
-				i += 1
-				p = int(i/n*100)
-				if p > 0 and p % pc == 0:
-					print("%3d%% :: same = %d, ij = %d, ji = %d, unsame = %d" % (p, self.same_pair_count, self.semisame_ij_count, self.semisame_ji_count, self.unsame_pair_count))
-					pc += ps
-				if a == b:
-					break
-				both_i = self._clustering_i.mapping[node_a] == self._clustering_i.mapping[node_b]
-				both_j = self._clustering_j.mapping[node_a] == self._clustering_j.mapping[node_b]
-				if both_i and both_j:
-					#self.same_pair.append((node_a, node_b))
-					self.same_pair_count += 1
-				elif both_i and not both_j:
-					#self.semisame_ij.append((node_a, node_b))
-					self.semisame_ij_count += 1
-				elif not both_i and both_j:
-					#self.semisame_ji.append((node_a, node_b))
-					self.semisame_ji_count += 1
-				elif not both_i and not both_j:
-					#self.unsame_pair.append((node_a, node_b))
-					self.unsame_pair_count += 1
-				else:
-					raise Exception('impossible same-pair alignment')
-
-		#self.same_pair_count = len(self.same_pair)
-		#self.semisame_ij_count = len(self.semisame_ij)
-		#self.semisame_ji_count = len(self.semisame_ji)
-		#self.unsame_pair_count = len(self.unsame_pair)
+		self.same_pair_count = _pair_sum(self.confusion_matrix.cell_counts)
+		self.semisame_ij_count = _pair_sum(self.confusion_matrix.row_sums()) - self.same_pair_count
+		self.semisame_ji_count = _pair_sum(self.confusion_matrix.column_sums()) - self.same_pair_count
+		self.unsame_pair_count = n - self.same_pair_count - self.semisame_ij_count - self.semisame_ji_count
 		self.count_of_pairs = self.same_pair_count + self.semisame_ij_count + self.semisame_ji_count + self.unsame_pair_count
 
 	def reverse(self):
-		return ClusteringComparator(self._clustering_j, self._clustering_i)
-
-	def save(self, name):
+		"""The comparator of j to i as a view on the transposed confusion matrix with the semi-same counts swapped."""
+		if self._reverse is None:
+			reverse = ClusteringComparator.__new__(ClusteringComparator)
+			reverse._clustering_i = self._clustering_j
+			reverse._clustering_j = self._clustering_i
+			reverse.base_set = self.base_set
+			reverse.base_set_size = self.base_set_size
+			reverse._metrics = {}
+			reverse._symmetric_metrics = self._symmetric_metrics
+			reverse._reverse = self
+			reverse.confusion_matrix = self.confusion_matrix.transpose()
+			reverse.semisame_ij = self.semisame_ji
+			reverse.semisame_ji = self.semisame_ij
+			reverse.same_pair_count = self.same_pair_count
+			reverse.semisame_ij_count = self.semisame_ji_count
+			reverse.semisame_ji_count = self.semisame_ij_count
+			reverse.unsame_pair_count = self.unsame_pair_count
+			reverse.count_of_pairs = self.count_of_pairs
+			self._reverse = reverse
+		return self._reverse
+
+	def metrics(self, names=None):
+		"""Values of the requested metrics (all of them by default) keyed by metric name, computing only those."""
+		names = list(METRICS) if names is None else names
+		for metric in names:
+			if metric not in METRICS:
+				raise Exception("Unknown metric: %s" % metric)
+		return collections.OrderedDict((metric, getattr(self, metric)()) for metric in names)
+
+	def save(self, name, sparse=False, metrics=None):
 		dir = os.path.join(os.path.dirname(name), '%s --- %s' % (self._clustering_i.name, self._clustering_j.name))
 		if os.path.isdir(dir):
 			shutil.rmtree(dir)
 		os.makedirs(dir)
-		self._save_confusion_matrix(dir)
+		self._save_confusion_matrix(dir, sparse=sparse)
 		self._save_pair_counts(dir)
-		self._save_metrics(dir)
+		self._save_metrics(dir, metrics)
 		#self._save_bad_pairs(dir)
 
-	def _save_confusion_matrix(self, dir):
+	def _save_confusion_matrix(self, dir, sparse=False):
+		"""Write every cell row by row, or with sparse only the non-zero cells as 'row;column;count' lines."""
+		if sparse:
+			with open(os.path.join(dir, 'confusion_matrix.sparse.csv'), 'w') as matrix:
+				for i, j, datum in self.confusion_matrix.cells():
+					matrix.write('%s;%s;%d\n' % (i, j, datum))
+			return
 		with open(os.path.join(dir, 'confusion_matrix.csv'), 'w') as matrix:
-			for k, line in self.confusion_matrix.items():
-				for l, datum in line.items():
-					matrix.write('%s;' % datum)
+			for line in self.confusion_matrix.dense_rows():
+				matrix.write(''.join('%s;' % datum for datum in line))
 				matrix.write('\n')
 
 	def _save_pair_counts(self, dir):
@@ -296,14 +513,10 @@ class ClusteringComparator():
 			count.write('unsame; %d\n' % self.unsame_pair_count)
 			count.write('base set size; %d\n' % self.base_set_size)
 
-	def _save_metrics(self, dir):
+	def _save_metrics(self, dir, metrics=None):
 		with open(os.path.join(dir, 'compare.csv'), 'w') as compare:
-			compare.write('Chi Squared coefficient;%f\n' % self.chi_squared_coefficient())
-			compare.write('Rand index;%f\n' % self.rand_index())
-			compare.write('Fowlkes-Mallows index;%f\n' % self.fowlkes_mallows_index())
-			compare.write('Jaccard index;%f\n' % self.jaccard_index())
-			compare.write('Mirkin metric;%f\n' % self.mirkin_metric())
-			compare.write('F-measure;%f\n' % self.f_measure())
+			for metric, value in self.metrics(metrics).items():
+				compare.write('%s;%f\n' % (METRICS[metric], value))
 
 	def _save_bad_pairs(self, dir):
 		for index, chunk in enumerate(chunks_of([pair for pair in self.semisame_ij if self._clustering_i.domain_of(pair[0]) != self._clustering_i.domain_of(pair[1])], 100000)):
@@ -319,73 +532,74 @@ class ClusteringComparator():
 					diff.write('clusters: %s - %s ; %s - %s\n' % (self._clustering_j.mapping[pair[0]], self._clustering_j.mapping[pair[1]], self._clustering_i.mapping[pair[0]], self._clustering_i.mapping[pair[1]]))
 					diff.write('hashes:   %s - %s ; %s - %s\n\n' % (hash_it(self._clustering_j.mapping[pair[0]]), hash_it(self._clustering_j.mapping[pair[1]]), hash_it(self._clustering_i.mapping[pair[0]]), hash_it(self._clustering_i.mapping[pair[1]])))
 
-	def dump(self):
+	def dump(self, metrics=None):
 		print('[Comparison] %s ---> %s' % (self._clustering_i.name, self._clustering_j.name))
-		print(' |  Chi Squared coefficient = %f' % self.chi_squared_coefficient())
-		print(' |  Rand index = %f' % self.rand_index())
-		print(' |  Fowlkes-Mallows index = %f' % self.fowlkes_mallows_index())
-		print(' |  Jaccard index = %f' % self.jaccard_index())
-		print(' |  Mirkin metric = %f' % self.mirkin_metric())
-		print(' |  F-measure = %f' % self.f_measure())
+		for metric, value in self.metrics(metrics).items():
+			print(' |  %s = %f' % (METRICS[metric], value))
 
+	@_memoized_metric
 	def chi_squared_coefficient(self):
-		chi = 0
-		for i, Ci in self._clustering_i.clusters.items():
-			for j, Cj  in self._clustering_j.clusters.items():
-				Eij = (len(Ci) * len(Cj)) / self.base_set_size
-				chi += ((self.confusion_matrix[i][j] - Eij) ** 2) / Eij
-		return chi
+		"""Sum of (n - E)^2 / E over all cells, expanded so that only the non-zero cells are visited."""
+		table = self.confusion_matrix
+		expected = table.row_sizes[table.cell_rows] * table.column_sizes[table.cell_columns] / self.base_set_size
+		all_expected = int(table.row_sizes.sum()) * int(table.column_sizes.sum()) / self.base_set_size
+		return float(np.sum(table.cell_counts ** 2 / expected)) - 2 * int(table.cell_counts.sum()) + all_expected
 
+	@_memoized_metric
 	def rand_index(self):
 		numerator = 2 * (self.same_pair_count + self.unsame_pair_count)
 		nominator = self.base_set_size * (self.base_set_size - 1)
 		return numerator / nominator
 
+	@_memoized_metric
 	def fowlkes_mallows_index(self):
 		nominator = math.sqrt((self.same_pair_count + self.semisame_ij_count) * (self.same_pair_count + self.semisame_ij_count))
 		return self.same_pair_count / nominator
 
+	@_memoized_metric
 	def jaccard_index(self):
 		nominator = self.same_pair_count + self.semisame_ij_count + self.semisame_ji_count
 		return self.same_pair_count / nominator
 
+	@_memoized_metric
 	def mirkin_metric(self):
-		a = sum([len(l) ** 2 for _, l in self._clustering_i.clusters.items()])
-		b = sum([len(l) ** 2 for _, l in self._clustering_j.clusters.items()])
-		m = 0
-		for i in self._clustering_i.clusters:
-			for j in self._clustering_j.clusters:
-				m += self.confusion_matrix[i][j] ** 2
+		table = self.confusion_matrix
+		a = int(np.sum(table.row_sizes ** 2))
+		b = int(np.sum(table.column_sizes ** 2))
+		m = int(np.sum(table.cell_counts ** 2))
 		return a + b - 2 * m
 
-	def _f_measure(self, i, j):
-		pij = self.confusion_matrix[i][j] / self._clustering_j.size_of[j]
-		rij = self.confusion_matrix[i][j] / self._clustering_i.size_of[i]
-		if pij == 0 and rij == 0:
-			return 0
-		return (2 * rij * pij) / (rij + pij)
-
+	@_memoized_metric
 	def f_measure(self):
-		a = 0
-		for i in self._clustering_i.clusters:
-			v = []
-			for j in self._clustering_j.clusters:
-				v.append(self._clustering_i.size_of[i] * self._f_measure(i, j))
-			a += max(v)
-		return a / self.base_set_size
+		"""Size weighted best F-measure of each cluster of i; zero cells have zero F-measure so only non-zero cells compete."""
+		table = self.confusion_matrix
+		row_sizes = table.row_sizes[table.cell_rows]
+		pij = table.cell_counts / table.column_sizes[table.cell_columns]
+		rij = table.cell_counts / row_sizes
+		best = np.zeros(len(table.rows))
+		np.maximum.at(best, table.cell_rows, row_sizes * ((2 * rij * pij) / (rij + pij)))
+		return sum(best.tolist()) / self.base_set_size
+
+def jaccard_of_overlap(overlap, size_a, size_b):
+	return overlap / (size_a + size_b - overlap)
+
+def f_measure_of_overlap(overlap, size_a, size_b):
+	pij = overlap / size_a
+	rij = overlap / size_b
+	if pij == 0 and rij == 0:
+		return 0
+	return (2 * rij * pij) / (rij + pij)
+
+def inclusion_of_overlap(overlap, size_a, size_b):
+	return overlap / size_a
 
 def jaccard_similarity_coefficient(a, b):
-	return len(a & b) / len(a | b)
+	return jaccard_of_overlap(len(a & b), len(a), len(b))
 
 def f_measuere(a, b):
-	confusion = len(a & b)
-	pij = confusion / len(a)
-	rij = confusion / len(b)
-	if pij == 0 and rij == 0:
-		return 0
-	return (2 * rij * pij) / (rij + pij)
+	return f_measure_of_overlap(len(a & b), len(a), len(b))
 
 def inclusion_coefficient(a, b):
-	return len(a & b) / len(a)
+	return inclusion_of_overlap(len(a & b), len(a), len(b))
 
 print("coverage_cluster.clustering was loaded.")
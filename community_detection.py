@@ -0,0 +1,127 @@
+import random
+import struct
+import numpy as np
+
+
+def adjacency_of(sources, targets, node_count, weights=None):
+	"""Build the symmetric CSR adjacency (indptr, indices, weights) of an undirected edge list.
+
+	Neighbours are sorted and repeated edges keep their first weight, the way the louvain convert tool cleans its input.
+	"""
+	sources = np.asarray(sources, dtype=np.int64)
+	targets = np.asarray(targets, dtype=np.int64)
+	weights = np.ones(len(sources)) if weights is None else np.asarray(weights, dtype=np.float64)
+	not_loop = sources != targets
+	rows = np.concatenate((sources, targets[not_loop]))
+	columns = np.concatenate((targets, sources[not_loop]))
+	values = np.concatenate((weights, weights[not_loop]))
+	keys, first = np.unique(rows * node_count + columns, return_index=True)
+	rows = keys // node_count if node_count else keys
+	indptr = np.zeros(node_count + 1, dtype=np.int64)
+	np.cumsum(np.bincount(rows, minlength=node_count), out=indptr[1:])
+	return indptr, keys - rows * node_count, values[first]
+
+def write_louvain_graph(graph_file, indptr, indices):
+	"""Write an unweighted adjacency in the binary format of the louvain tool, as its convert tool would."""
+	graph_file.write(struct.pack('<i', len(indptr) - 1))
+	graph_file.write(np.asarray(indptr[1:], dtype='<u8').tobytes())
+	graph_file.write(np.asarray(indices, dtype='<i4').tobytes())
+
+def _one_level(indptr, indices, weights, order, min_gain):
+	"""Move nodes between communities while modularity improves, as in Blondel et al.'s one_level."""
+	node_count = len(indptr) - 1
+	row_of_entry = np.repeat(np.arange(node_count), np.diff(indptr))
+	degrees = np.bincount(row_of_entry, weights=weights, minlength=node_count)
+	self_loops = np.bincount(row_of_entry[row_of_entry == indices], weights=weights[row_of_entry == indices], minlength=node_count)
+	total_weight = float(degrees.sum())
+	if total_weight == 0:
+		return np.arange(node_count), False
+
+	pointers = indptr.tolist()
+	neighbours = indices.tolist()
+	link_weights = weights.tolist()
+	degree = degrees.tolist()
+	loop = self_loops.tolist()
+	community = list(range(node_count))
+	tot = list(degree)
+	inside = list(loop)
+
+	def modularity():
+		return sum(i / total_weight - (t / total_weight) ** 2 for i, t in zip(inside, tot) if t > 0)
+
+	current = modularity()
+	improved = False
+	while True:
+		moves = 0
+		for node in order:
+			own = community[node]
+			node_degree = degree[node]
+			links = {own: 0.}
+			for position in range(pointers[node], pointers[node + 1]):
+				neighbour = neighbours[position]
+				if neighbour != node:
+					neighbour_community = community[neighbour]
+					links[neighbour_community] = links.get(neighbour_community, 0.) + link_weights[position]
+			tot[own] -= node_degree
+			inside[own] -= 2 * links[own] + loop[node]
+			best = own
+			best_gain = 0.
+			for candidate, weight in links.items():
+				gain = weight - tot[candidate] * node_degree / total_weight
+				if gain > best_gain:
+					best = candidate
+					best_gain = gain
+			tot[best] += node_degree
+			inside[best] += 2 * links.get(best, 0.) + loop[node]
+			if best != own:
+				community[node] = best
+				moves += 1
+		new = modularity()
+		if moves > 0:
+			improved = True
+		if moves == 0 or new - current <= min_gain:
+			break
+		current = new
+	return np.array(community, dtype=np.int64), improved
+
+def _induced_graph(indptr, indices, weights, communities):
+	node_count = len(indptr) - 1
+	_, renumbered = np.unique(communities, return_inverse=True)
+	community_count = int(renumbered.max()) + 1 if node_count else 0
+	rows = renumbered[np.repeat(np.arange(node_count), np.diff(indptr))]
+	columns = renumbered[indices]
+	keys, inverse = np.unique(rows * community_count + columns, return_inverse=True)
+	induced_weights = np.bincount(inverse, weights=weights, minlength=len(keys))
+	induced_rows = keys // community_count
+	induced_indptr = np.zeros(community_count + 1, dtype=np.int64)
+	np.cumsum(np.bincount(induced_rows, minlength=community_count), out=induced_indptr[1:])
+	return renumbered, (induced_indptr, keys % community_count, induced_weights)
+
+def louvain(indptr, indices, weights=None, min_gain=0.000001, seed=None):
+	"""Multi-level Louvain community detection on a CSR adjacency.
+
+	Returns the final community of every node and the list of partitions found at each level,
+	every partition mapping the original nodes to the communities of that level.
+	Nodes are visited in index order unless a seed is given for shuffling them.
+	"""
+	graph = (np.asarray(indptr, dtype=np.int64), np.asarray(indices, dtype=np.int64), np.ones(len(indices)) if weights is None else np.asarray(weights, dtype=np.float64))
+	node_count = len(graph[0]) - 1
+	if node_count == 0:
+		return np.zeros(0, dtype=np.int64), []
+	shuffle = random.Random(seed).shuffle if seed is not None else None
+	membership = np.arange(node_count)
+	levels = []
+	while True:
+		order = list(range(len(graph[0]) - 1))
+		if shuffle:
+			shuffle(order)
+		communities, improved = _one_level(*graph, order, min_gain)
+		renumbered, graph = _induced_graph(*graph, communities)
+		if improved or not levels:
+			membership = renumbered[membership]
+			levels.append(membership)
+		if not improved:
+			break
+	return membership, levels
+
+print("coverage_cluster.community_detection was loaded.")
@@ -0,0 +1,90 @@
+import collections
+import os
+import pickle
+import numpy as np
+
+from clustering import *
+
+
+def _count_edges(mapping, sources, targets, good_edges, bad_edges, sign):
+	for source, target in zip(sources.tolist(), targets.tolist()):
+		cluster = mapping.get(str(source))
+		if cluster is None:
+			continue
+		counts = good_edges if cluster == mapping.get(str(target)) else bad_edges
+		counts[cluster] = counts.get(cluster, 0) + sign
+
+class IncrementalAnalysis(object):
+	"""Results of the previous revision updated by the delta of an incremental ingestion, while at most max_change of the nodes changed."""
+	def __init__(self, path, max_change=0.1):
+		self.path = path
+		self.max_change = max_change
+		self.previous = None
+		if os.path.isfile(path):
+			with open(path, 'rb') as state:
+				self.previous = pickle.load(state)
+
+	def applies_to(self, coverage):
+		delta = coverage.delta
+		if self.previous is None:
+			return False
+		if delta is None:
+			return self.previous['digest'] == coverage.digest and self.previous.get('nodes') == coverage.data.ids_digest()
+		if self.previous['digest'] != delta.previous_digest:
+			return False
+		return len(delta.added_nodes) + len(delta.removed_nodes) <= self.max_change * max(len(coverage.data), 1)
+
+	def save(self, coverage, detected_clustering, declared_clustering, comparator):
+		state = dict(digest=coverage.ingestion_state.digest, nodes=coverage.data.ids_digest(), detected=detected_clustering.mapping, declared=declared_clustering.mapping, edge_counts=detected_clustering.edge_counts, cells={(row, column): count for row, column, count in comparator.confusion_matrix.cells()})
+		with open(self.path, 'wb') as output:
+			pickle.dump(state, output, protocol=pickle.HIGHEST_PROTOCOL)
+
+	def detected_clustering(self, coverage, name, key='community_cluster'):
+		delta = coverage.delta
+		if delta is None:
+			return Clustering(dict(self.previous['detected']), name, key, coverage.data)
+		removed = set(str(node) for node in delta.removed_nodes.tolist())
+		mapping = {node: cluster for node, cluster in self.previous['detected'].items() if node not in removed}
+		next_cluster = max([int(cluster) for cluster in mapping.values() if cluster.isdigit()] + [-1]) + 1
+
+		sources, targets = delta.added_edges
+		ends = np.concatenate((sources, targets))
+		others = np.concatenate((targets, sources))
+		is_added = np.isin(ends, delta.added_nodes)
+		neighbours = collections.defaultdict(list)
+		for node, neighbour in zip(ends[is_added].tolist(), others[is_added].tolist()):
+			neighbours[node].append(str(neighbour))
+		for node in delta.added_nodes.tolist():
+			votes = collections.Counter(mapping[neighbour] for neighbour in neighbours[node] if neighbour in mapping)
+			if votes:
+				mapping[str(node)] = votes.most_common(1)[0][0]
+			else:
+				mapping[str(node)] = str(next_cluster)
+				next_cluster += 1
+		return Clustering(mapping, name, key, coverage.data)
+
+	def update_c_confidence(self, detected_clustering, delta):
+		good_edges, bad_edges = (dict(counts) for counts in self.previous['edge_counts'])
+		if delta is None:
+			detected_clustering.set_c_confidence(good_edges, bad_edges)
+			return
+		_count_edges(self.previous['detected'], *delta.removed_edges, good_edges, bad_edges, -1)
+		_count_edges(detected_clustering.mapping, *delta.added_edges, good_edges, bad_edges, 1)
+		detected_clustering.set_c_confidence(good_edges, bad_edges)
+
+	def compare(self, declared_clustering, detected_clustering, delta):
+		"""Comparator from the previous contingency table, with the added, removed and relabelled nodes moved."""
+		declared, detected = self.previous['declared'], self.previous['detected']
+		counts = dict(self.previous['cells'])
+		removed = [str(node) for node in delta.removed_nodes.tolist()] if delta is not None else []
+		added = [str(node) for node in delta.added_nodes.tolist()] if delta is not None else []
+		relabelled = [node for node, cluster in declared_clustering.mapping.items() if node in declared and declared[node] != cluster]
+		for node in removed + relabelled:
+			cell = (declared[node], detected[node])
+			counts[cell] -= 1
+		for node in added + relabelled:
+			cell = (declared_clustering.mapping[node], detected_clustering.mapping[node])
+			counts[cell] = counts.get(cell, 0) + 1
+		return ClusteringComparator(declared_clustering, detected_clustering, confusion_matrix=ContingencyTable.of_cells(declared_clustering, detected_clustering, counts))
+
+print("coverage_cluster.incremental was loaded.")
@@ -0,0 +1,371 @@
+import collections
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import numpy as np
+
+from nodetable import *
+
+BLOCK_BYTES = 16 * 1024 * 1024
+_PARSE_EXPANSION = 16
+_SHARDS_PER_WORKER = 4
+
+_SEMICOLON = ord(';')
+_NEWLINE = ord('\n')
+_ZERO = ord('0')
+_NINE = ord('9')
+
+
+def _read_blocks(matrix_file, block_bytes):
+	while True:
+		lines = matrix_file.readlines(block_bytes)
+		if not lines:
+			return
+		yield b''.join(lines)
+
+def _next_semicolon(semicolons, indices, default):
+	if not len(semicolons):
+		return np.full(len(indices), default, dtype=np.int64)
+	bounded = np.minimum(indices, len(semicolons) - 1)
+	return np.where(indices < len(semicolons), semicolons[bounded], default)
+
+def _parse_block(buffer):
+	"""Parse raw matrix rows into test names and the CSR (indptr, indices) of their covered cells."""
+	if not buffer.endswith(b'\n'):
+		buffer += b'\n'
+	raw = np.frombuffer(buffer, dtype=np.uint8)
+	last = len(raw) - 1
+	is_semicolon = raw == _SEMICOLON
+	is_newline = raw == _NEWLINE
+	semicolons = np.flatnonzero(is_semicolon)
+	newlines = np.flatnonzero(is_newline)
+	row_count = len(newlines)
+	line_starts = np.concatenate(([0], newlines[:-1] + 1))
+	first_semicolon_of_row = np.searchsorted(semicolons, line_starts)
+
+	is_zero = (raw[semicolons + 1] == _ZERO) & (is_semicolon | is_newline)[np.minimum(semicolons + 2, last)]
+	candidates = np.flatnonzero(~is_zero)
+	starts = semicolons[candidates] + 1
+	rows = np.searchsorted(newlines, starts)
+	ends = np.minimum(newlines[rows], _next_semicolon(semicolons, candidates + 1, last))
+	first_digits = raw[starts]
+	single_digit = (ends - starts == 1) & (first_digits >= _ZERO) & (first_digits <= _NINE)
+	covered = single_digit & (first_digits > _ZERO)
+	# other cells go through int() so that malformed ones still fail
+	other_cells = np.flatnonzero(~single_digit)
+	covered[other_cells] = [int(buffer[s:e]) > 0 for s, e in zip(starts[other_cells].tolist(), ends[other_cells].tolist())]
+
+	rows = rows[covered]
+	indices = candidates[covered] - first_semicolon_of_row[rows]
+	indptr = np.zeros(row_count + 1, dtype=np.int64)
+	np.cumsum(np.bincount(rows, minlength=row_count), out=indptr[1:])
+
+	name_ends = np.minimum(_next_semicolon(semicolons, first_semicolon_of_row, last), newlines)
+	whole_line = (name_ends == newlines).tolist()
+	names = [buffer[s:e].decode('utf-8').strip() if whole else buffer[s:e].decode('utf-8').lstrip() for s, e, whole in zip(line_starts.tolist(), name_ends.tolist(), whole_line)]
+	return names, indptr, indices
+
+class CoverageMatrix(object):
+	"""Sparse test x code element view of a SoDA coverage matrix, rows are stored in CSR form."""
+	def __init__(self, code_elements):
+		self.code_elements = code_elements
+		self.test_names = []
+		self._indptr = [np.zeros(1, dtype=np.int64)]
+		self._indices = []
+		self._nnz = 0
+
+	def __len__(self):
+		return len(self.test_names)
+
+	def append_block(self, names, indptr, indices):
+		self.test_names.extend(names)
+		self._indptr.append(indptr[1:] + self._nnz)
+		self._indices.append(indices)
+		self._nnz += len(indices)
+
+	@property
+	def indptr(self):
+		if len(self._indptr) > 1:
+			self._indptr = [np.concatenate(self._indptr)]
+		return self._indptr[0]
+
+	@property
+	def indices(self):
+		if len(self._indices) != 1:
+			self._indices = [np.concatenate(self._indices) if self._indices else np.zeros(0, dtype=np.int64)]
+		return self._indices[0]
+
+
+class NodeNumbering(object):
+	"""Node ids in the order the covered cells are walked, as the serial conversion numbered them."""
+	def __init__(self, column_count, retain_tests=True):
+		self.code_ids = np.full(column_count, -1, dtype=np.int64)
+		self.next_id = 0
+		self.retain_tests = retain_tests
+		self._test_ids = []
+
+	def number_block(self, indptr, indices):
+		starts = indptr[:-1]
+		test_rows = np.flatnonzero(indptr[1:] > starts)
+		test_positions = starts[test_rows]
+		columns, first_positions = np.unique(indices, return_index=True)
+		is_new = self.code_ids[columns] < 0
+		new_columns = columns[is_new]
+		new_positions = first_positions[is_new]
+		code_count = len(new_columns)
+
+		id_keys = np.concatenate((2 * new_positions, 2 * test_positions + 1))
+		ids = np.empty(len(id_keys), dtype=np.int64)
+		ids[np.argsort(id_keys)] = np.arange(self.next_id, self.next_id + len(id_keys))
+		self.next_id += len(id_keys)
+		self.code_ids[new_columns] = ids[:code_count]
+		test_ids = np.full(len(starts), -1, dtype=np.int64)
+		test_ids[test_rows] = ids[code_count:]
+		if self.retain_tests:
+			self._test_ids.append(test_ids)
+
+		order = np.argsort(np.concatenate((2 * new_positions + 1, 2 * test_positions)))
+		references = np.concatenate((new_columns, test_rows))
+		return test_ids, ids[order], (order >= code_count).astype(np.uint8), references[order]
+
+	@property
+	def test_ids(self):
+		if len(self._test_ids) != 1:
+			self._test_ids = [np.concatenate(self._test_ids) if self._test_ids else np.zeros(0, dtype=np.int64)]
+		return self._test_ids[0]
+
+	def edges_of_block(self, indptr, indices, test_ids):
+		return self.code_ids[indices], np.repeat(test_ids, np.diff(indptr))
+
+	def edge_arrays(self, matrix):
+		return self.edges_of_block(matrix.indptr, matrix.indices, self.test_ids)
+
+
+IngestionReport = collections.namedtuple('IngestionReport', 'rows nodes edges blocks block_bytes memory_budget peak_memory')
+
+def peak_memory():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _edge_lines(sources, targets):
+	return ''.join(map('%d %d\n'.__mod__, zip(sources.tolist(), targets.tolist())))
+
+def _data_lines(ids, domains, names):
+	dumps = json.dumps
+	return ''.join(['["%d", {"name": %s, "domain": "%s"}]\n' % (node_id, dumps(name), DOMAINS[domain]) for node_id, domain, name in zip(ids.tolist(), domains.tolist(), names)])
+
+def _ingest_blocks(parsed_blocks, code_elements, matrix=None, numbering=None, nodes=None):
+	"""Shared block loop of the conversions: append to the matrix, number and name the nodes of every parsed block."""
+	for test_names, indptr, indices in parsed_blocks:
+		if matrix is not None:
+			matrix.append_block(test_names, indptr, indices)
+		if numbering is None:
+			yield test_names, indptr, indices, None, None, None, None
+			continue
+		test_ids, ids, domains, references = numbering.number_block(indptr, indices)
+		names = [sys.intern(test_names[r]) if d else code_elements[r] for d, r in zip(domains.tolist(), references.tolist())]
+		if nodes is not None:
+			nodes.extend(ids, domains, names)
+		yield test_names, indptr, indices, test_ids, ids, domains, names
+
+def convert_matrix(matrix_csv_path, edge_list_path, data_mapping_path, block_bytes=BLOCK_BYTES, count_lines=None, streaming=False, memory_budget=None, workers=1, row_offsets=None):
+	"""Convert the coverage matrix to an edge list and data mapping block by block; streaming keeps only the node table."""
+	if workers > 1:
+		if streaming:
+			raise Exception("Streaming ingestion cannot be combined with parallel workers")
+		if row_offsets is None:
+			raise Exception("Parallel ingestion needs the row offsets of the matrix")
+		return _convert_sharded(matrix_csv_path, edge_list_path, data_mapping_path, block_bytes, workers, row_offsets)
+	if memory_budget:
+		block_bytes = max(memory_budget // _PARSE_EXPANSION, 1)
+	rows = edges = blocks = 0
+	with open(matrix_csv_path, 'rb') as matrix_file, open(edge_list_path, 'w') as edge_list, open(data_mapping_path, 'w') as data_mapping:
+		code_elements = _read_header(matrix_file)
+		matrix = None if streaming else CoverageMatrix(code_elements)
+		numbering = NodeNumbering(len(code_elements), retain_tests=not streaming)
+		nodes = NodeTableBuilder()
+		parsed_blocks = (_parse_block(block) for block in _read_blocks(matrix_file, block_bytes))
+		for test_names, indptr, indices, test_ids, ids, domains, names in _ingest_blocks(parsed_blocks, code_elements, matrix, numbering, nodes):
+			edge_list.write(_edge_lines(*numbering.edges_of_block(indptr, indices, test_ids)))
+			data_mapping.write(_data_lines(ids, domains, names))
+			rows += len(test_names)
+			edges += len(indices)
+			blocks += 1
+			if count_lines:
+				print("converting matrix to edges, done: %.4f" % (rows / count_lines))
+	table = nodes.table()
+	report = IngestionReport(rows=rows, nodes=len(table), edges=edges, blocks=blocks, block_bytes=block_bytes, memory_budget=memory_budget, peak_memory=peak_memory())
+	return matrix, numbering, table, report
+
+def _read_header(matrix_file):
+	header = next(matrix_file).decode('utf-8').strip()
+	return header.split(';')[1:]
+
+def _read_range(matrix_file, start, stop, block_bytes):
+	matrix_file.seek(start)
+	position = start
+	while position < stop:
+		block = matrix_file.read(min(block_bytes, stop - position))
+		if not block:
+			return
+		if not block.endswith(b'\n') and position + len(block) < stop:
+			block += matrix_file.readline()
+		position += len(block)
+		yield block
+
+def _parse_shard(task):
+	matrix_csv_path, start, stop, block_bytes = task
+	test_names = []
+	indptrs = [np.zeros(1, dtype=np.int64)]
+	indices = []
+	nnz = 0
+	with open(matrix_csv_path, 'rb') as matrix_file:
+		for block in _read_range(matrix_file, start, stop, block_bytes):
+			block_names, block_indptr, block_indices = _parse_block(block)
+			test_names.extend(block_names)
+			indptrs.append(block_indptr[1:] + nnz)
+			indices.append(block_indices)
+			nnz += len(block_indices)
+	return test_names, np.concatenate(indptrs), np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+
+def _render_edges(edges):
+	return _edge_lines(*edges)
+
+def _shard_ranges(row_offsets, data_start, data_stop, shard_count):
+	targets = data_start + (data_stop - data_start) * np.arange(1, shard_count) // shard_count
+	boundaries = row_offsets[np.minimum(np.searchsorted(row_offsets, targets), len(row_offsets) - 1)]
+	boundaries = np.unique(np.clip(boundaries, data_start, data_stop)).tolist()
+	edges = [data_start] + [b for b in boundaries if data_start < b < data_stop] + [data_stop]
+	return list(zip(edges[:-1], edges[1:]))
+
+def _convert_sharded(matrix_csv_path, edge_list_path, data_mapping_path, block_bytes, workers, row_offsets):
+	"""Parse row ranges in worker processes and number the shards in order."""
+	with open(matrix_csv_path, 'rb') as matrix_file:
+		code_elements = _read_header(matrix_file)
+		data_start = matrix_file.tell()
+	data_stop = os.path.getsize(matrix_csv_path)
+	ranges = _shard_ranges(row_offsets, data_start, data_stop, workers * _SHARDS_PER_WORKER)
+
+	matrix = CoverageMatrix(code_elements)
+	numbering = NodeNumbering(len(code_elements))
+	nodes = NodeTableBuilder()
+	edges = []
+	with multiprocessing.Pool(workers) as pool, open(data_mapping_path, 'w') as data_mapping:
+		shards = pool.imap(_parse_shard, [(matrix_csv_path, start, stop, block_bytes) for start, stop in ranges])
+		for test_names, indptr, indices, test_ids, ids, domains, names in _ingest_blocks(shards, code_elements, matrix, numbering, nodes):
+			data_mapping.write(_data_lines(ids, domains, names))
+			edges.append(numbering.edges_of_block(indptr, indices, test_ids))
+		with open(edge_list_path, 'w') as edge_list:
+			for lines in pool.imap(_render_edges, edges):
+				edge_list.write(lines)
+	table = nodes.table()
+	report = IngestionReport(rows=len(matrix), nodes=len(table), edges=len(matrix.indices), blocks=len(ranges), block_bytes=block_bytes, memory_budget=None, peak_memory=peak_memory())
+	return matrix, numbering, table, report
+
+
+MatrixDelta = collections.namedtuple('MatrixDelta', 'previous_digest added_nodes removed_nodes added_edges removed_edges')
+
+def _occurrence_keys(names):
+	"""Names made unique by appending the occurrence number to every repeated one."""
+	seen = {}
+	keys = []
+	for name in names:
+		count = seen.get(name, 0)
+		seen[name] = count + 1
+		keys.append(name if count == 0 else '%s;%d' % (name, count))
+	return keys
+
+def _pack_strings(strings):
+	return np.frombuffer('\n'.join(strings).encode('utf-8'), dtype=np.uint8)
+
+def _unpack_strings(packed, count):
+	return packed.tobytes().decode('utf-8').split('\n') if count else []
+
+class IngestionState(object):
+	"""Node ids of a converted matrix keyed by name, kept to convert the next revision incrementally."""
+	def __init__(self, digest, test_keys, test_ids, code_keys, code_ids, indptr, indices, next_id):
+		self.digest = digest
+		self.test_keys = test_keys
+		self.test_ids = np.asarray(test_ids, dtype=np.int64)
+		self.code_keys = code_keys
+		self.code_ids = np.asarray(code_ids, dtype=np.int64)
+		self.indptr = np.asarray(indptr, dtype=np.int64)
+		self.indices = np.asarray(indices, dtype=np.int64)
+		self.next_id = next_id
+
+	@classmethod
+	def of_conversion(cls, digest, matrix, numbering):
+		covered = numbering.test_ids >= 0
+		test_keys = [key for key, is_covered in zip(_occurrence_keys(matrix.test_names), covered.tolist()) if is_covered]
+		columns = np.flatnonzero(numbering.code_ids >= 0)
+		code_keys = _occurrence_keys(matrix.code_elements)
+		indptr = np.concatenate(([0], matrix.indptr[1:][covered]))
+		return cls(digest, test_keys, numbering.test_ids[covered], [code_keys[column] for column in columns.tolist()], numbering.code_ids[columns], indptr, numbering.code_ids[matrix.indices], numbering.next_id)
+
+	def edge_arrays(self):
+		return self.indices, np.repeat(self.test_ids, np.diff(self.indptr))
+
+	def save(self, path):
+		with open(path, 'wb') as state:
+			np.savez(state, digest=np.frombuffer(self.digest, dtype=np.uint8), test_keys=_pack_strings(self.test_keys), test_ids=self.test_ids, code_keys=_pack_strings(self.code_keys), code_ids=self.code_ids, indptr=self.indptr, indices=self.indices, next_id=np.array(self.next_id))
+
+	@classmethod
+	def load(cls, path):
+		if not os.path.isfile(path):
+			return None
+		with np.load(path) as state:
+			return cls(state['digest'].tobytes(), _unpack_strings(state['test_keys'], len(state['test_ids'])), state['test_ids'], _unpack_strings(state['code_keys'], len(state['code_ids'])), state['code_ids'], state['indptr'], state['indices'], int(state['next_id']))
+
+def _stable_ids(keys, id_of_key, next_id):
+	ids = []
+	for key in keys:
+		node_id = id_of_key.get(key)
+		if node_id is None:
+			node_id = next_id
+			next_id += 1
+		ids.append(node_id)
+	return np.array(ids, dtype=np.int64), next_id
+
+def update_matrix(matrix_csv_path, edge_list_path, data_mapping_path, state, digest, block_bytes=BLOCK_BYTES):
+	"""Convert a new revision of the matrix keeping the node ids of the previous one, with the MatrixDelta between them."""
+	with open(matrix_csv_path, 'rb') as matrix_file:
+		code_elements = _read_header(matrix_file)
+		matrix = CoverageMatrix(code_elements)
+		blocks = 0
+		for _ in _ingest_blocks((_parse_block(block) for block in _read_blocks(matrix_file, block_bytes)), code_elements, matrix):
+			blocks += 1
+
+	columns = np.unique(matrix.indices)
+	code_keys = _occurrence_keys(code_elements)
+	code_keys = [code_keys[column] for column in columns.tolist()]
+	code_ids, next_id = _stable_ids(code_keys, dict(zip(state.code_keys, state.code_ids.tolist())), state.next_id)
+	id_of_column = np.full(len(code_elements), -1, dtype=np.int64)
+	id_of_column[columns] = code_ids
+
+	rows = np.flatnonzero(np.diff(matrix.indptr) > 0)
+	test_keys = _occurrence_keys(matrix.test_names)
+	test_keys = [test_keys[row] for row in rows.tolist()]
+	test_ids, next_id = _stable_ids(test_keys, dict(zip(state.test_keys, state.test_ids.tolist())), next_id)
+	new_state = IngestionState(digest, test_keys, test_ids, code_keys, code_ids, np.concatenate(([0], matrix.indptr[1:][rows])), id_of_column[matrix.indices], next_id)
+
+	old_edges = np.repeat(state.test_ids, np.diff(state.indptr)) * next_id + state.indices
+	new_edges = np.repeat(new_state.test_ids, np.diff(new_state.indptr)) * next_id + new_state.indices
+	added_edges = np.setdiff1d(new_edges, old_edges)
+	removed_edges = np.setdiff1d(old_edges, new_edges)
+	old_nodes = np.concatenate((state.test_ids, state.code_ids))
+	new_nodes = np.concatenate((test_ids, code_ids))
+	delta = MatrixDelta(previous_digest=state.digest, added_nodes=np.setdiff1d(new_nodes, old_nodes), removed_nodes=np.setdiff1d(old_nodes, new_nodes), added_edges=(added_edges % next_id, added_edges // next_id), removed_edges=(removed_edges % next_id, removed_edges // next_id))
+
+	order = np.argsort(new_nodes)
+	domains = np.concatenate((np.ones(len(test_ids), dtype=np.uint8), np.zeros(len(code_ids), dtype=np.uint8)))[order]
+	all_names = [sys.intern(matrix.test_names[row]) for row in rows.tolist()] + [code_elements[column] for column in columns.tolist()]
+	names = [all_names[index] for index in order.tolist()]
+	table = NodeTable(new_nodes[order], domains, names)
+	with open(edge_list_path, 'w') as edge_list, open(data_mapping_path, 'w') as data_mapping:
+		edge_list.write(_edge_lines(*new_state.edge_arrays()))
+		data_mapping.write(_data_lines(table.ids, domains, names))
+	report = IngestionReport(rows=len(matrix), nodes=len(table), edges=len(new_state.indices), blocks=blocks, block_bytes=block_bytes, memory_budget=None, peak_memory=peak_memory())
+	return table, new_state, delta, report
+
+print("coverage_cluster.ingestion was loaded.")
@@ -4,6 +4,8 @@ from os.path import basename, splitext
 
 from algorithm import *
 from smell import *
+from incremental import *
+from cache import *
 
 parser = argparse.ArgumentParser(description = 'ILYA Test Clustering')
 parser.add_argument('-c', '--coverage', required = True, help = 'the SoDA coverage csv file')
@@ -12,47 +14,110 @@ parser.add_argument('-d', '--direct', required = True, help = 'the JDT based dir
 parser.add_argument('-t', '--type', choices = ['unit', 'integration'], default = 'unit', help = 'type of the test suite')
 parser.add_argument('--pt', type = float, default = 0.0, help = 'P-confidence threshold')
 parser.add_argument('--ct', type = float, default = 0.0, help = 'C-confidence threshold')
-args = parser.parse_args()
-
-coverage_file = args.coverage
-labels_dir = args.labels
-direct_calls_file = args.direct
-test_type = args.type
-p_threshold = args.pt
-c_threshold = args.ct
-
-outputname = coverage_file[:-4]
-name = splitext(basename(coverage_file))[0]
-
-print("Processing coverage based data...")
-coverage = CoverageBasedData(coverage_file, drop_uncovered=True, regenerate_edge_list=False)
-print("Creating community based clusters...")
-detected_clustering = coverage.community_based_clustering(name='%s-detected' % name, regenerate_external_data=False)
-print("Calculating confidence...")
-detected_clustering.calculate_c_confidence(coverage.edge_list_path)
-print("Creating package based clusters...")
-declared_clustering = coverage.package_based_clustering(name='%s-declared' % name, labels_dir=labels_dir)
-print("Calculating confidence...")
-declared_clustering.calculate_p_confidence(direct_calls_file)
-print("Comparing declared to detected...")
-comparison_dec_det = declared_clustering.compare_to(detected_clustering)
-print("Comparing detected to declared...")
-comparison_det_dec = comparison_dec_det.reverse()
-
-comparison_dec_det.dump()
-print("Saving dec-det...")
-comparison_dec_det.save(outputname)
-comparison_det_dec.dump()
-print("Saving det-dec...")
-comparison_det_dec.save(outputname)
-
-print("Saving coverage...")
-coverage.save(outputname, clusterings=[detected_clustering, declared_clustering], similarity_constrain=lambda v: v > 0)
-print("Saving detected clusters...")
-detected_clustering.save('%s_detected' % outputname)
-print("Saving declared clusters...")
-declared_clustering.save('%s_declared' % outputname)
-print("Measurement saved.")
-
-sniffer = Sniffer(coverage.similarity_models, declared_clustering, detected_clustering, test_type, p_threshold, c_threshold)
-sniffer.save(outputname)
+parser.add_argument('--pt-sweep', type = parse_thresholds, default = None, help = 'P-confidence thresholds to sweep, as a comma separated list or start:stop:step')
+parser.add_argument('--ct-sweep', type = parse_thresholds, default = None, help = 'C-confidence thresholds to sweep, as a comma separated list or start:stop:step')
+parser.add_argument('--cut-step', type = float, default = .05, help = 'threshold step of the cut distribution')
+parser.add_argument('--export', nargs = '+', choices = ['graphml', 'binary', 'none'], default = ['graphml'], help = 'formats of the exported similarity models')
+parser.add_argument('--package-levels', type = int, default = 1, help = 'also compare the detected clusters to the package clusters of this many package depths')
+parser.add_argument('--louvain', choices = ['external', 'builtin'], default = 'external', help = 'run the bundled louvain binaries or the built-in implementation')
+parser.add_argument('--workers', type = int, default = 1, help = 'number of processes converting the coverage matrix and loading the labels')
+parser.add_argument('--memory-budget', type = int, default = None, help = 'stream the coverage matrix within this memory budget (in MB)')
+parser.add_argument('--incremental', action = 'store_true', help = 'convert a changed coverage matrix against the previous run and update its results by the delta')
+parser.add_argument('--cache-dir', default = None, help = 'directory of the stage cache (default: next to the coverage file)')
+parser.add_argument('--cache-size', type = int, default = 1024, help = 'size limit of the stage cache (in MB)')
+parser.add_argument('--no-cache', action = 'store_true', help = 'compute every stage without the stage cache')
+parser.add_argument('--metrics', nargs = '+', choices = list(METRICS), default = None, help = 'compute and save only these comparison metrics')
+def analyze(coverage_file, labels_dir, direct_calls_file, test_type='unit', p_threshold=0.0, c_threshold=0.0, p_thresholds=None, c_thresholds=None, cut_step=.05, export=('graphml',), package_levels=1, louvain_engine='external', workers=1, memory_budget=None, metrics=None, incremental=False, cache_dir=None, cache_size=1024 * 2 ** 20, use_cache=True, label_index=None):
+	"""Run the whole analysis of one coverage file, writing its results next to it.
+
+	Returns a summary of the project: the comparator metrics in both directions and the smell counts.
+	"""
+	outputname = coverage_file[:-4]
+	name = splitext(basename(coverage_file))[0]
+	cache = StageCache(cache_dir or '%s.cache' % outputname, max_bytes=cache_size, enabled=use_cache)
+
+	print("Processing coverage based data...")
+	coverage = CoverageBasedData(coverage_file, drop_uncovered=True, regenerate_edge_list=False, streaming=memory_budget is not None, memory_budget=memory_budget, workers=workers, incremental=incremental)
+	nodes_digest = coverage.data.ids_digest()
+	analysis = IncrementalAnalysis('%s.analysis.pickle' % outputname) if incremental else None
+	updating = analysis is not None and analysis.applies_to(coverage)
+	print("Creating community based clusters...")
+	if updating:
+		detected_key = None
+		detected_clustering = analysis.detected_clustering(coverage, name='%s-detected' % name)
+	else:
+		detected_key = cache.key('communities', coverage.digest, nodes_digest, louvain_engine)
+		detected_mapping = cache.stage(detected_key, lambda: coverage.community_based_clustering(name='%s-detected' % name, regenerate_external_data=True, engine=louvain_engine).mapping)
+		detected_clustering = Clustering(detected_mapping, '%s-detected' % name, 'community_cluster', coverage.data)
+	print("Calculating confidence...")
+	c_key = cache.key('c-confidence', detected_key)
+	if updating:
+		analysis.update_c_confidence(detected_clustering, coverage.delta)
+	else:
+		detected_clustering.set_c_confidence(*cache.stage(c_key, lambda: detected_clustering.c_confidence_counts(*coverage.edge_arrays())))
+	print("Creating package based clusters...")
+	declared_key = cache.key('declared', coverage.digest, nodes_digest, labels_fingerprint(labels_dir))
+	declared_mapping = cache.stage(declared_key, lambda: coverage.package_based_clustering(name='%s-declared' % name, labels_dir=labels_dir, workers=workers, label_index=label_index).mapping)
+	declared_clustering = Clustering(declared_mapping, '%s-declared' % name, 'declared_cluster', coverage.data)
+	print("Calculating confidence...")
+	p_key = cache.key('p-confidence', declared_key, file_digest(direct_calls_file))
+	def p_confidence():
+		declared_clustering.calculate_p_confidence(direct_calls_file)
+		return declared_clustering.confidence
+	declared_clustering.confidence = cache.stage(p_key, p_confidence)
+	print("Comparing declared to detected...")
+	if updating:
+		comparison_dec_det = analysis.compare(declared_clustering, detected_clustering, coverage.delta)
+	else:
+		confusion_matrix = cache.stage(cache.key('comparison', declared_key, detected_key), lambda: ContingencyTable(declared_clustering, detected_clustering, list(declared_clustering.base_set | detected_clustering.base_set)))
+		comparison_dec_det = ClusteringComparator(declared_clustering, detected_clustering, confusion_matrix=confusion_matrix)
+	if analysis is not None:
+		analysis.save(coverage, detected_clustering, declared_clustering, comparison_dec_det)
+	print("Comparing detected to declared...")
+	comparison_det_dec = comparison_dec_det.reverse()
+
+	comparison_dec_det.dump(metrics)
+	print("Saving dec-det...")
+	comparison_dec_det.save(outputname, metrics=metrics)
+	comparison_det_dec.dump(metrics)
+	print("Saving det-dec...")
+	comparison_det_dec.save(outputname, metrics=metrics)
+
+	if package_levels > 1:
+		print("Comparing package levels to detected...")
+		package_hierarchy = coverage.package_hierarchy(name='%s-package' % name, levels=package_levels)
+		confusion_matrices = cache.stage(cache.key('package-comparisons', coverage.digest, nodes_digest, detected_key, package_levels), lambda: [comparison.confusion_matrix for comparison in package_hierarchy.compare_to(detected_clustering).values()])
+		for level, confusion_matrix in zip(package_hierarchy.levels(), confusion_matrices):
+			comparison = ClusteringComparator(package_hierarchy.clustering(level), detected_clustering, confusion_matrix=confusion_matrix)
+			comparison.dump(metrics)
+			comparison.save(outputname, metrics=metrics)
+
+	print("Saving coverage...")
+	models_key = cache.key('similarity-models', detected_key, declared_key, 'similarity > 0')
+	similarity_models = cache.stage(models_key, lambda: coverage.build_similarity_models([detected_clustering, declared_clustering], similarity_constrain=lambda v: v > 0))
+	coverage.save(outputname, export=export, similarity_models=similarity_models)
+	print("Saving detected clusters...")
+	detected_clustering.save('%s_detected' % outputname)
+	print("Saving declared clusters...")
+	declared_clustering.save('%s_declared' % outputname)
+	print("Measurement saved.")
+
+	smells_key = cache.key('smells', models_key, c_key, p_key, test_type, p_threshold, c_threshold, cut_step)
+	cached_smells, detections = cache.get(smells_key)
+	sniffer = Sniffer(coverage.similarity_models, declared_clustering, detected_clustering, test_type, p_threshold, c_threshold, resolution=list(unirange(0, 1, cut_step)), detections=detections)
+	if cached_smells:
+		print("Stage %s is cached" % smells_key)
+	else:
+		cache.put(smells_key, sniffer.detections())
+	sniffer.save(outputname)
+	if p_thresholds is not None or c_thresholds is not None:
+		print("Sweeping confidence thresholds...")
+		sniffer.sweep(p_thresholds or [p_threshold], c_thresholds or [c_threshold])
+		sniffer.save_sweep(outputname)
+
+	return {'name': name, 'declared-detected': comparison_dec_det.metrics(metrics), 'detected-declared': comparison_det_dec.metrics(metrics), 'alter egos': sniffer.alter_ego_count, 'clean cuts': sniffer.clean_cut_count, 'smells': len(sniffer.smells)}
+
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+	analyze(args.coverage, args.labels, args.direct, test_type=args.type, p_threshold=args.pt, c_threshold=args.ct, p_thresholds=args.pt_sweep, c_thresholds=args.ct_sweep, cut_step=args.cut_step, export=[model_format for model_format in args.export if model_format != 'none'], package_levels=args.package_levels, louvain_engine=args.louvain, workers=args.workers, memory_budget=args.memory_budget * 2 ** 20 if args.memory_budget else None, metrics=args.metrics, incremental=args.incremental, cache_dir=args.cache_dir, cache_size=args.cache_size * 2 ** 20, use_cache=not args.no_cache)
@@ -0,0 +1,149 @@
+import collections.abc
+import hashlib
+import mmap
+import os
+import struct
+import numpy as np
+
+DOMAINS = ('code', 'test')
+
+_MAGIC = b'ILYANODE'
+_VERSION = 1
+_HEADER = struct.Struct('<8sQQQ32s')
+
+
+def file_digest(path):
+	digest = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(32 * 1024 * 1024), b''):
+			digest.update(chunk)
+	return digest.digest()
+
+def _aligned(offset):
+	return (offset + 7) // 8 * 8
+
+
+class _NameBlob(collections.abc.Sequence):
+	"""Node names decoded on access from one UTF-8 blob."""
+	def __init__(self, blob, offsets):
+		self._blob = blob
+		self._offsets = offsets
+
+	def __getitem__(self, row):
+		if isinstance(row, slice):
+			return [self[r] for r in range(*row.indices(len(self)))]
+		if row < 0:
+			row += len(self)
+		if not 0 <= row < len(self):
+			raise IndexError(row)
+		return str(self._blob[int(self._offsets[row]):int(self._offsets[row + 1])], 'utf-8')
+
+	def __len__(self):
+		return len(self._offsets) - 1
+
+
+class NodeTable(collections.abc.Mapping):
+	"""Names and domains of the coverage graph nodes as parallel arrays, keyed by node id strings like the former data dict."""
+	def __init__(self, ids, domains, names, row_of_id=None):
+		self.ids = np.asarray(ids, dtype=np.int64)
+		self.domains = np.asarray(domains, dtype=np.uint8)
+		self.names = names
+		if row_of_id is None:
+			row_of_id = np.full(int(self.ids.max()) + 1 if len(self.ids) else 0, -1, dtype=np.int64)
+			row_of_id[self.ids] = np.arange(len(self.ids))
+		self.row_of_id = row_of_id
+
+	def save(self, path, digest):
+		encoded = [name.encode('utf-8') for name in self.names]
+		offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+		offsets[1:] = np.cumsum([len(name) for name in encoded])
+		blob = b''.join(encoded)
+		with open(path, 'wb') as table:
+			table.write(_HEADER.pack(_MAGIC, _VERSION, len(self.ids), len(self.row_of_id), digest))
+			table.write(self.ids.tobytes())
+			table.write(self.row_of_id.tobytes())
+			table.write(offsets.tobytes())
+			table.write(self.domains.tobytes())
+			table.write(b'\0' * (_aligned(len(self.domains)) - len(self.domains)))
+			table.write(blob)
+
+	@classmethod
+	def load(cls, path, digest):
+		"""Memory-map a saved table, or return None when it is missing or was built from other content."""
+		if not os.path.isfile(path) or os.path.getsize(path) < _HEADER.size:
+			return None
+		with open(path, 'rb') as table:
+			buffer = mmap.mmap(table.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, count, id_count, stored_digest = _HEADER.unpack_from(buffer)
+		if magic != _MAGIC or version != _VERSION or stored_digest != digest:
+			buffer.close()
+			return None
+		position = _HEADER.size
+		ids = np.frombuffer(buffer, dtype=np.int64, count=count, offset=position)
+		position += ids.nbytes
+		row_of_id = np.frombuffer(buffer, dtype=np.int64, count=id_count, offset=position)
+		position += row_of_id.nbytes
+		offsets = np.frombuffer(buffer, dtype=np.uint64, count=count + 1, offset=position)
+		position += offsets.nbytes
+		domains = np.frombuffer(buffer, dtype=np.uint8, count=count, offset=position)
+		position += _aligned(count)
+		table = cls(ids, domains, _NameBlob(memoryview(buffer)[position:], offsets), row_of_id=row_of_id)
+		table._buffer = buffer
+		return table
+
+	def ids_digest(self):
+		"""Fingerprint of the node numbering, which incremental updates can change for the same matrix."""
+		return hashlib.sha256(self.ids.tobytes()).hexdigest()
+
+	def _row(self, node):
+		try:
+			node_id = int(node)
+		except (TypeError, ValueError):
+			raise KeyError(node)
+		if 0 <= node_id < len(self.row_of_id):
+			row = self.row_of_id[node_id]
+			if row >= 0:
+				return row
+		raise KeyError(node)
+
+	def name_of(self, node):
+		return self.names[self._row(node)]
+
+	def domain_of(self, node):
+		return DOMAINS[self.domains[self._row(node)]]
+
+	def __getitem__(self, node):
+		row = self._row(node)
+		return {'name': self.names[row], 'domain': DOMAINS[self.domains[row]]}
+
+	def __contains__(self, node):
+		try:
+			self._row(node)
+		except KeyError:
+			return False
+		return True
+
+	def __iter__(self):
+		return (str(node_id) for node_id in self.ids.tolist())
+
+	def __len__(self):
+		return len(self.ids)
+
+
+class NodeTableBuilder(object):
+	def __init__(self):
+		self._ids = []
+		self._domains = []
+		self.names = []
+
+	def extend(self, ids, domains, names):
+		self._ids.append(ids)
+		self._domains.append(domains)
+		self.names.extend(names)
+
+	def table(self):
+		ids = np.concatenate(self._ids) if self._ids else np.zeros(0, dtype=np.int64)
+		domains = np.concatenate(self._domains) if self._domains else np.zeros(0, dtype=np.uint8)
+		return NodeTable(ids, domains, self.names)
+
+print("coverage_cluster.nodetable was loaded.")
@@ -0,0 +1,102 @@
+import numpy as np
+
+_GRAPHML_HEADER = '<?xml version=\'1.0\' encoding=\'utf-8\'?>\n<graphml xmlns="http://graphml.graphdrawing.org/xmlns" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">'
+_GRAPHML_TYPES = {str: 'string', int: 'long', float: 'double', bool: 'boolean'}
+_NODE_ATTRIBUTES = ('id', 'clustering', 'node_count', 'suggested_name')
+_EDGE_ATTRIBUTES = ('similarity', 'label')
+
+
+def _escape_text(text):
+	return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+class SimilarityGraph(object):
+	"""Directed similarity model of clusters, its node attributes in parallel arrays and its edges in CSR form."""
+	def __init__(self, similarity_name, cluster_ids, clustering_keys, node_counts, suggested_names, sources, targets, similarities):
+		self.similarity_name = similarity_name
+		self.cluster_ids = list(cluster_ids)
+		self.clusterings = list(dict.fromkeys(clustering_keys))
+		code_of_key = {key: code for code, key in enumerate(self.clusterings)}
+		self.clustering_codes = np.array([code_of_key[key] for key in clustering_keys], dtype=np.int64)
+		self.node_counts = np.asarray(node_counts, dtype=np.int64)
+		self.suggested_names = list(suggested_names)
+		sources = np.asarray(sources, dtype=np.int64)
+		order = np.argsort(sources, kind='stable')
+		self.indptr = np.zeros(len(self.cluster_ids) + 1, dtype=np.int64)
+		np.cumsum(np.bincount(sources, minlength=len(self.cluster_ids)), out=self.indptr[1:])
+		self.targets = np.asarray(targets, dtype=np.int64)[order]
+		self.similarities = np.asarray(similarities, dtype=np.float64)[order]
+		self.out_degree = np.diff(self.indptr)
+
+	def __len__(self):
+		return len(self.cluster_ids)
+
+	def number_of_edges(self):
+		return len(self.targets)
+
+	def clustering_of(self, node):
+		return self.clusterings[self.clustering_codes[node]]
+
+	def nodes_of(self, clustering_key):
+		if clustering_key not in self.clusterings:
+			return np.zeros(len(self), dtype=bool)
+		return self.clustering_codes == self.clusterings.index(clustering_key)
+
+	def sources(self):
+		return np.repeat(np.arange(len(self)), self.out_degree)
+
+	def out_targets(self, node):
+		return self.targets[self.indptr[node]:self.indptr[node + 1]]
+
+	def label_of(self, similarity):
+		return '%s = %.2f' % (self.similarity_name, similarity)
+
+	def _node_attributes(self, node):
+		return (self.cluster_ids[node], self.clustering_of(node), int(self.node_counts[node]), self.suggested_names[node])
+
+	def write_graphml(self, path, chunk=4096):
+		"""Stream the model as the GraphML networkx wrote for the former DiGraph models."""
+		keys = {}
+		for node in range(len(self)):
+			for name, value in zip(_NODE_ATTRIBUTES, self._node_attributes(node)):
+				keys.setdefault((name, _GRAPHML_TYPES[type(value)], 'node'), 'd%d' % len(keys))
+		if self.number_of_edges():
+			for name, value in zip(_EDGE_ATTRIBUTES, (0.0, '')):
+				keys.setdefault((name, _GRAPHML_TYPES[type(value)], 'edge'), 'd%d' % len(keys))
+		key_of_value = lambda name, value, scope: keys[(name, _GRAPHML_TYPES[type(value)], scope)]
+		with open(path, 'w', encoding='utf-8') as graphml:
+			graphml.write(_GRAPHML_HEADER)
+			for (name, attribute_type, scope), key in reversed(list(keys.items())):
+				graphml.write('\n  <key id="%s" for="%s" attr.name="%s" attr.type="%s" />' % (key, scope, name, attribute_type))
+			if len(self) == 0:
+				graphml.write('\n  <graph edgedefault="directed" />\n</graphml>\n')
+				return
+			graphml.write('\n  <graph edgedefault="directed">')
+			for start in range(0, len(self), chunk):
+				lines = []
+				for node in range(start, min(start + chunk, len(self))):
+					lines.append('\n    <node id="%d">' % node)
+					for name, value in zip(_NODE_ATTRIBUTES, self._node_attributes(node)):
+						lines.append('\n      <data key="%s">%s</data>' % (key_of_value(name, value, 'node'), _escape_text(str(value))))
+					lines.append('\n    </node>')
+				graphml.write(''.join(lines))
+			similarity_key, label_key = keys.get(('similarity', 'double', 'edge')), keys.get(('label', 'string', 'edge'))
+			sources = self.sources()
+			for start in range(0, self.number_of_edges(), chunk):
+				lines = []
+				for source, target, similarity in zip(sources[start:start + chunk].tolist(), self.targets[start:start + chunk].tolist(), self.similarities[start:start + chunk].tolist()):
+					lines.append('\n    <edge source="%d" target="%d">\n      <data key="%s">%r</data>\n      <data key="%s">%s</data>\n    </edge>' % (source, target, similarity_key, similarity, label_key, _escape_text(self.label_of(similarity))))
+				graphml.write(''.join(lines))
+			graphml.write('\n  </graph>\n</graphml>\n')
+
+	def save_binary(self, path):
+		np.savez(path, similarity_name=np.array(self.similarity_name), cluster_ids=np.array([str(cluster_id) for cluster_id in self.cluster_ids], dtype=str), clusterings=np.array(self.clusterings, dtype=str), clustering_codes=self.clustering_codes, node_counts=self.node_counts, suggested_names=np.array(self.suggested_names, dtype=str), indptr=self.indptr, targets=self.targets, similarities=self.similarities)
+
+	@classmethod
+	def load_binary(cls, path):
+		with np.load(path) as columns:
+			clusterings = columns['clusterings'].tolist()
+			sources = np.repeat(np.arange(len(columns['indptr']) - 1), np.diff(columns['indptr']))
+			return cls(str(columns['similarity_name']), columns['cluster_ids'].tolist(), [clusterings[code] for code in columns['clustering_codes'].tolist()], columns['node_counts'], columns['suggested_names'].tolist(), sources, columns['targets'], columns['similarities'])
+
+print("coverage_cluster.similarity_graph was loaded.")
@@ -1,4 +1,7 @@
-import networkx as nx
+import argparse
+import bisect
+import collections
+import numpy as np
 import pdb
 import statistics
 import json
@@ -10,51 +13,76 @@ def unirange(start, stop, step):
 		r += step
 		yield r
 
+def parse_thresholds(text):
+	"""Thresholds given as a comma separated list, or as an inclusive start:stop:step range."""
+	if ':' in text:
+		try:
+			start, stop, step = [float(part) for part in text.split(':')]
+		except ValueError:
+			raise argparse.ArgumentTypeError("Threshold range should be start:stop:step (%s)" % text)
+		if step <= 0:
+			raise argparse.ArgumentTypeError("Threshold step must be positive (%s)" % text)
+		count = int((stop - start) / step + 1e-9) + 1
+		return [round(start + i * step, 10) for i in range(count)]
+	return [float(part) for part in text.split(',') if part.strip()]
+
+_DETECTIONS = ('alter_ego_count', 'clean_cut_count', 'cut_distribution', 'chimera_distribution', 'base_histograms', 'derived_histograms', 'smells')
+
 class Sniffer(object):
-	def __init__(self, graphs, base_clustering, derived_clustering, test_type, base_conf_limit, derived_conf_limit, resolution=list(unirange(0, 1, .05))):
+	def __init__(self, graphs, base_clustering, derived_clustering, test_type, base_conf_limit, derived_conf_limit, resolution=list(unirange(0, 1, .05)), detections=None):
 		self.graphs = graphs
 		self.base_clustering = base_clustering
 		self.derived_clustering = derived_clustering
 		self.test_type = test_type
 		self.base_conf_limit = base_conf_limit
 		self.derived_conf_limit = derived_conf_limit
-		self.detect(base_clustering, derived_clustering, resolution=list(unirange(0, 1, .05)))
+		self._cut_cache = {}
+		self._index()
+		if detections is None:
+			self.detect(base_clustering, derived_clustering, resolution=resolution)
+		else:
+			self.__dict__.update(detections)
+
+	def _index(self):
+		"""Index the jaccard graph once: the first node of each cluster id."""
+		self._node_of_id = {}
+		for node, cluster_id in enumerate(self.graphs['jaccard'].cluster_ids):
+			self._node_of_id.setdefault(cluster_id, node)
+
+	def _node_of(self, cluster_id):
+		node = self._node_of_id.get(cluster_id)
+		if node is None:
+			raise Exception("Cluster (%s) cannot be found in the graph" % cluster_id)
+		return node
 
 	def detect_alter_ego(self, clustering):
-		count = 0
-		for node, data in self.graphs['jaccard'].nodes(data=True):
-			if data['clustering'] == clustering.key:
-				out_edges = self.graphs['jaccard'].out_edges(node, data=True)
-				if len(out_edges) == 1 and out_edges[0][2]['similarity'] == 1:
-					count += 1
-		return count
+		graph = self.graphs['jaccard']
+		single = graph.nodes_of(clustering.key) & (graph.out_degree == 1)
+		return int(np.count_nonzero(graph.similarities[graph.indptr[:-1][single]] == 1))
+
+	def _cut_similarities(self, base_clustering, derived_clustering):
+		"""Sorted minimal similarity of the in-edges from derived clusters, for every base cluster split into several parts.
+
+		A base cluster is cut at a threshold when any such in-edge is not more similar than the threshold,
+		so it is enough to keep the minimum; base clusters without such in-edges get infinity.
+		"""
+		key = (base_clustering.key, derived_clustering.key)
+		if key not in self._cut_cache:
+			graph = self.graphs['inclusion']
+			split = graph.nodes_of(base_clustering.key) & (graph.out_degree > 1)
+			split[split] = graph.similarities[graph.indptr[:-1][split]] < 1
+			from_derived = graph.nodes_of(derived_clustering.key)[graph.sources()]
+			minimal = np.full(len(graph), np.inf)
+			np.minimum.at(minimal, graph.targets[from_derived], graph.similarities[from_derived])
+			self._cut_cache[key] = np.sort(minimal[split]).tolist()
+		return self._cut_cache[key]
 
 	def detect_clean_cut(self, base_clustering, derived_clustering):
-		count = 0
-		for node, node_data in self.graphs['inclusion'].nodes(data=True):
-			if node_data['clustering'] == base_clustering.key:
-				out_edges = self.graphs['inclusion'].out_edges(node, data=True)
-				if len(out_edges) > 1 and out_edges[0][2]['similarity'] < 1:
-					for source, target, edge_data in self.graphs['inclusion'].in_edges(node, data=True):
-						if self.graphs['inclusion'].node[source]['clustering'] == derived_clustering.key:
-							if edge_data['similarity'] < 1:
-								break
-					else:
-						count += 1
-		return count
+		similarities = self._cut_similarities(base_clustering, derived_clustering)
+		return len(similarities) - bisect.bisect_left(similarities, 1)
 
 	def detect_cut(self, base_clustering, derived_clustering, threshold=1):
-		count = 0
-		for node, node_data in self.graphs['inclusion'].nodes(data=True):
-			if node_data['clustering'] == base_clustering.key:
-				out_edges = self.graphs['inclusion'].out_edges(node, data=True)
-				if len(out_edges) > 1 and out_edges[0][2]['similarity'] < 1:
-					for source, target, edge_data in self.graphs['inclusion'].in_edges(node, data=True):
-						if self.graphs['inclusion'].node[source]['clustering'] == derived_clustering.key:
-							if edge_data['similarity'] <= threshold:
-								count += 1
-								break
-		return count
+		return bisect.bisect_right(self._cut_similarities(base_clustering, derived_clustering), threshold)
 
 	def detect_cut_distribution(self, base_clustering, derived_clustering, thresholds):
 		counts = {}
@@ -66,12 +94,11 @@ class Sniffer(object):
 
 	def detect_chimera_distribution(self, clustering):
 		print("counting chimeras by number of parts")
+		graph = self.graphs['jaccard']
 		counts = {}
-		for node, node_data in self.graphs['jaccard'].nodes(data=True):
-			if node_data['clustering'] == clustering.key:
-				count_of_parts = len(self.graphs['jaccard'].out_edges(node, data=True))
-				if count_of_parts > 1:
-					counts[count_of_parts] = counts.get(count_of_parts, 0) + 1
+		for count_of_parts in graph.out_degree[graph.nodes_of(clustering.key)].tolist():
+			if count_of_parts > 1:
+				counts[count_of_parts] = counts.get(count_of_parts, 0) + 1
 		for i in range(max(counts.keys())):
 			counts[i] = counts.get(i, 0)
 		print("number of parts;\tcount")
@@ -79,26 +106,18 @@ class Sniffer(object):
 		return counts
 
 	def chimera_vector_of(self, cluster_id):
-		node = None
-		for node_id, node_data in self.graphs['jaccard'].nodes(data=True):
-			if node_data['id'] == cluster_id:
-				node = node_id
-				break
-
-		histogram = {}
-		for source, target, edge_data in self.graphs['jaccard'].out_edges(node, data=True):
-			count_of_parts = len(self.graphs['jaccard'].out_edges(target, data=True))
-			histogram[count_of_parts] = histogram.get(count_of_parts, 0) + 1
-		for i in range(max(histogram.keys())):
-			histogram[i] = histogram.get(i, 0)
-
-		return [v for k, v in sorted(histogram.items(), key=lambda x: x[0])][1:]
+		"""Number of similar clusters by their own number of similar clusters, from 1 up to the largest."""
+		graph = self.graphs['jaccard']
+		count_of_parts = graph.out_degree[graph.out_targets(self._node_of(cluster_id))]
+		if len(count_of_parts) == 0:
+			raise Exception("Cluster (%s) is not similar to any cluster" % cluster_id)
+		return np.bincount(count_of_parts)[1:].tolist()
 
 	def detect_chimera_vector(self, clustering):
+		graph = self.graphs['jaccard']
 		histograms = {}
-		for node, node_data in self.graphs['jaccard'].nodes(data=True):
-			if node_data['clustering'] == clustering.key:
-				histograms[node_data['id']] = self.chimera_vector_of(node_data['id'])
+		for node in np.flatnonzero(graph.nodes_of(clustering.key)).tolist():
+			histograms[graph.cluster_ids[node]] = self.chimera_vector_of(graph.cluster_ids[node])
 
 		return histograms
 
@@ -121,35 +140,32 @@ class Sniffer(object):
 		else:
 			return ' '
 
-	def check_cluster(self, cluster_id):
-		def check_p(cluster='global'):
-			c = self.base_clustering.get_confidence(cluster)
-			return c > self.base_conf_limit
+	def check_cluster(self, cluster_id, p_ok=None, c_ok=None):
+		"""Verdict of the cluster, with the global P and C confidence checks against the limits unless given."""
+		if p_ok is None:
+			p_ok = self.base_clustering.get_confidence('global') > self.base_conf_limit
+		if c_ok is None:
+			c_ok = self.derived_clustering.get_confidence('global') > self.derived_conf_limit
+		clustering, rule_vector = self._rule_of(cluster_id)
+		return self._verdict(clustering, rule_vector, p_ok, c_ok)
 
-		def check_c(cluster='global'):
-			c = self.derived_clustering.get_confidence(cluster)
-			return c > self.derived_conf_limit
-
-		node = None
-		data = None
+	def _rule_of(self, cluster_id):
+		clustering = self.graphs['jaccard'].clustering_of(self._node_of(cluster_id))
+		vector = self.chimera_vector_of(cluster_id)
+		return clustering, self.check_chimera_vector(vector)
 
-		for node_id, node_data in self.graphs['jaccard'].nodes(data=True):
-			if node_data['id'] == cluster_id:
-				node = node_id
-				data = node_data
-				break
+	def _verdict(self, clustering, rule_vector, p_ok, c_ok):
+		def check_p():
+			return p_ok
 
-		if node is None or data is None:
-			raise Exception("Cluster (%s) cannot be found in the graph" % cluster_id)
-
-		vector = self.chimera_vector_of(cluster_id)
-		rule_vector = self.check_chimera_vector(vector)
+		def check_c():
+			return c_ok
 
 		if self.test_type == 'unit':
 			if rule_vector == '1':
 				return (False, rule_vector)
 			else:
-				if data['clustering'] == self.base_clustering.key: # P cluster
+				if clustering == self.base_clustering.key: # P cluster
 					if rule_vector == '-':
 						if check_p():
 							if check_c(): #TODO check neighbours separately
@@ -172,7 +188,7 @@ class Sniffer(object):
 								return (True, rule_vector)
 							else:
 								pass
-				elif data['clustering'] == self.derived_clustering.key: # C cluster
+				elif clustering == self.derived_clustering.key: # C cluster
 					if rule_vector == '-':
 						if check_c():
 							if check_p(): #TODO check neighbours separately
@@ -196,12 +212,12 @@ class Sniffer(object):
 							else:
 								pass
 				else:
-					raise Exception("Unexpected clustering key (%s)" % data['clustering'])
+					raise Exception("Unexpected clustering key (%s)" % clustering)
 		elif self.test_type == 'integration':
 			if rule_vector == '1':
 				pass
 			else:
-				if data['clustering'] == self.base_clustering.key:  # P cluster
+				if clustering == self.base_clustering.key:  # P cluster
 					if rule_vector == '-':
 						if check_p():
 							if check_c():  # TODO check neighbours separately
@@ -224,8 +240,7 @@ class Sniffer(object):
 								pass
 							else:
 								pass
-				elif data[
-					'clustering'] == self.derived_clustering.key:  # C cluster
+				elif clustering == self.derived_clustering.key:  # C cluster
 					if rule_vector == '-':
 						if check_c():
 							if check_p():  # TODO check neighbours separately
@@ -250,18 +265,17 @@ class Sniffer(object):
 								pass
 				else:
 					raise Exception(
-						"Unexpected clustering key (%s)" % data['clustering'])
+						"Unexpected clustering key (%s)" % clustering)
 		else:
 			raise Exception("Unexpected test type (%s)" % self.test_type)
 
 		return None
 
-	def detect_smells(self):
+	def detect_smells(self, p_ok=None, c_ok=None):
 		smells = []
 
-		for node_id, node_data in self.graphs['jaccard'].nodes(data=True):
-			cluster_id = node_data['id']
-			result = self.check_cluster(cluster_id)
+		for cluster_id in self.graphs['jaccard'].cluster_ids:
+			result = self.check_cluster(cluster_id, p_ok, c_ok)
 
 			if not (result is None):
 				if result[0]:
@@ -269,6 +283,37 @@ class Sniffer(object):
 
 		return smells
 
+	def sweep(self, base_conf_limits, derived_conf_limits):
+		"""Smells for every pair of P and C confidence limits.
+
+		Only the global confidences depend on the limits, so the verdict of each cluster is computed for the
+		four outcomes of the P and C checks once and every limit pair just picks its outcome.
+		"""
+		outcomes = [(p_ok, c_ok) for p_ok in (False, True) for c_ok in (False, True)]
+		smells_of = {outcome: [] for outcome in outcomes}
+		for cluster_id in self.graphs['jaccard'].cluster_ids:
+			clustering, rule_vector = self._rule_of(cluster_id)
+			for outcome in outcomes:
+				result = self._verdict(clustering, rule_vector, *outcome)
+				if not (result is None) and result[0]:
+					smells_of[outcome].append((cluster_id, result[1]))
+		base_confidence = self.base_clustering.get_confidence('global')
+		derived_confidence = self.derived_clustering.get_confidence('global')
+		self.sweep_smells = collections.OrderedDict()
+		for base_conf_limit in base_conf_limits:
+			for derived_conf_limit in derived_conf_limits:
+				self.sweep_smells[(base_conf_limit, derived_conf_limit)] = smells_of[(base_confidence > base_conf_limit, derived_confidence > derived_conf_limit)]
+		return self.sweep_smells
+
+	def save_sweep(self, outputname):
+		with open('%s.smells-sweep.csv' % outputname, 'w') as sweep:
+			sweep.write("p threshold; c threshold; smells\n")
+			sweep.write("\n".join(['%f; %f; %d' % (p, c, len(smells)) for (p, c), smells in self.sweep_smells.items()]))
+			sweep.write("\n")
+			sweep.write("p threshold; c threshold; cluster; smell\n")
+			sweep.write("\n".join(['%f; %f; %s; %s' % (p, c, cluster, smell) for (p, c), smells in self.sweep_smells.items() for cluster, smell in smells]))
+			sweep.write("\n")
+
 	def detect(self, base_clustering, derived_clustering, resolution=list(unirange(0, 1, .05))):
 		self.alter_ego_count = self.detect_alter_ego(base_clustering)
 		print("%d alter ego was detected" % self.alter_ego_count)
@@ -281,6 +326,10 @@ class Sniffer(object):
 		self.smells = self.detect_smells()
 		print("%d smells were detected" % len(self.smells))
 
+	def detections(self):
+		"""The results of detect(), to pass to a new sniffer of the same models and clusterings instead of detecting again."""
+		return {name: getattr(self, name) for name in _DETECTIONS}
+
 	def save(self, outputname):
 		with open('%s.smells-count.csv' % outputname, 'w') as smells_count:
 			smells_count.write("alter egos; %d\n" % self.alter_ego_count)